@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+    Compares per-request cost of checking request filters one by one against
+    the compiled RequestFilterSet.
+
+    The legacy path loads all filters with a polymorphic query and calls
+    check_request on each of them, which is what fhost() used to do for
+    every POST. The compiled path checks the generation counter and then
+    consults a RequestFilterSet built once up front.
+
+    Runs against an in-memory SQLite database:
+
+        python bench/filters.py --filters 5000 --requests 500
+"""
+
+import argparse
+import ipaddress
+import random
+import sys
+import time
+from pathlib import Path
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fhost import app, db, AddrFilter, NetFilter, UAFilter, MIMEFilter, \
+    RequestFilter, RequestFilterSet, Generation  # noqa: E402
+
+
+def make_filters(n: int, rnd: random.Random) -> list:
+    filters = []
+    for i in range(n):
+        match i % 10:
+            case 0 | 1 | 2 | 3 | 4 | 5:
+                addr = ipaddress.ip_address(rnd.getrandbits(32))
+                filters.append(AddrFilter(addr))
+            case 6 | 7:
+                plen = rnd.randint(12, 28)
+                net = ipaddress.ip_network(
+                    (rnd.getrandbits(32) >> (32 - plen) << (32 - plen), plen))
+                filters.append(NetFilter(net))
+            case 8:
+                filters.append(UAFilter(f"bot-{i}/[0-9.]+"))
+            case 9:
+                filters.append(MIMEFilter(f"application/x-test-{i}"))
+    return filters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--filters", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    engine = sa.create_engine("sqlite://")
+    db.metadata.create_all(engine, tables=[RequestFilter.__table__,
+                                           Generation.__table__])
+
+    filters = make_filters(args.filters, rnd)
+    banned = [str(f.addr) for f in filters if isinstance(f, AddrFilter)]
+
+    with Session(engine) as session:
+        session.add_all(filters)
+        session.add(Generation(name="request_filter", value=1))
+        session.commit()
+
+    # Roughly one in ten requests comes from a blocked address
+    addrs = [rnd.choice(banned) if rnd.random() < 0.1
+             else str(ipaddress.ip_address(rnd.getrandbits(32)))
+             for _ in range(args.requests)]
+
+    def run(check) -> float:
+        blocked = 0
+        start = time.perf_counter()
+        for addr in addrs:
+            with app.test_request_context(
+                    "/", method="POST", environ_base={"REMOTE_ADDR": addr},
+                    headers={"User-Agent": "curl/8.0"}):
+                from flask import request
+                if check(request):
+                    blocked += 1
+        elapsed = time.perf_counter() - start
+        return elapsed / len(addrs), blocked
+
+    with Session(engine) as session:
+        def legacy(r):
+            session.expunge_all()
+            for flt in session.scalars(sa.select(RequestFilter)):
+                if flt.check_request(r):
+                    return flt
+            return None
+
+        start = time.perf_counter()
+        fset = RequestFilterSet(session.scalars(sa.select(RequestFilter)))
+        build = time.perf_counter() - start
+
+        gen = sa.select(Generation.value) \
+            .where(Generation.name == "request_filter")
+
+        def compiled(r):
+            session.scalar(gen)
+            return fset.check_request(r)
+
+        lt, lb = run(legacy)
+        ct, cb = run(compiled)
+
+    print(f"{args.filters} filters, {args.requests} requests")
+    print(f"  query + loop:         {lt * 1e6:10.1f} µs/request "
+          f"({lb} blocked)")
+    print(f"  generation + compiled:{ct * 1e6:10.1f} µs/request "
+          f"({cb} blocked)")
+    print(f"  compiled set built in {build * 1e3:.1f} ms, "
+          f"speedup {lt / ct:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
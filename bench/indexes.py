@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+    Times the queries of prune, vscan and the moderation interface before
+    and after adding the file table indexes.
+
+    A synthetic file table is seeded into a temporary SQLite database. The
+    indexes are dropped and added back by running the migration that adds
+    them, so this also checks it applies cleanly:
+
+        python bench/indexes.py --rows 2000000
+"""
+
+import argparse
+import datetime
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fhost import File  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+MIGRATION = ROOT / "migrations" / "versions" / \
+    "f3b7a9c2d815_add_file_indexes.py"
+
+MIMES = [("image/png", ".png"), ("image/jpeg", ".jpg"), ("video/mp4", ".mp4"),
+         ("text/plain; charset=utf-8", ".txt"), ("application/zip", ".zip"),
+         ("application/pdf", ".pdf"), ("audio/mpeg", ".mp3")]
+UAS = ["curl/8.5.0", "Mozilla/5.0 (X11; Linux x86_64)", "Wget/1.21.4",
+       "python-requests/2.31.0", None]
+
+
+def seed(engine, rows: int, rnd: random.Random) -> None:
+    now = int(time.time() * 1000)
+    day = 24 * 60 * 60 * 1000
+    scanned = datetime.datetime.now()
+
+    def make(i):
+        mime, ext = rnd.choice(MIMES)
+        r = rnd.random()
+        if r < 0.3:
+            expiration = None               # already pruned
+        elif r < 0.31:
+            expiration = now - rnd.randint(1, day)  # due for pruning
+        else:
+            expiration = now + rnd.randint(1, 365) * day
+        return {
+            "sha256": rnd.randbytes(32).hex(),
+            "ext": ext,
+            "mime": mime,
+            "addr": rnd.randbytes(16),
+            "ua": rnd.choice(UAS),
+            "removed": rnd.random() < 0.001,
+            "nsfw_score": rnd.random() if rnd.random() < 0.8 else None,
+            "expiration": expiration,
+            "mgmt_token": "x",
+            "last_vscan": None if rnd.random() < 0.02 else
+            scanned - datetime.timedelta(hours=rnd.randint(0, 8 * 24)),
+            "size": rnd.randint(1, 256 * 1024 * 1024),
+        }
+
+    table = File.__table__
+    with engine.begin() as conn:
+        for start in range(0, rows, 50000):
+            conn.execute(table.insert(), [make(i) for i in
+                                          range(start, min(rows,
+                                                           start + 50000))])
+
+
+def queries(addr: bytes) -> dict:
+    now = int(time.time() * 1000)
+    scandate = datetime.datetime.now() - datetime.timedelta(days=7)
+    f = File.__table__.c
+    return {
+        "prune": sa.select(f.id).where(
+            f.expiration.is_not(None), f.expiration < now,
+            sa.tuple_(f.expiration, f.id) > (0, 0))
+            .order_by(f.expiration, f.id).limit(500),
+        "vscan": sa.select(f.id).where(sa.or_(f.last_vscan < scandate,
+                                              f.last_vscan.is_(None)),
+                                       f.removed == False),
+        "removed index": sa.select(f.sha256).where(f.removed),
+        "mod: addr": sa.select(f.id).where(f.addr == addr),
+        "mod: mime": sa.select(f.id).where(f.mime.like("video/%")),
+        "mod: ext": sa.select(f.id).where(f.ext.like(".pdf")),
+        "mod: ua": sa.select(f.id).where(f.ua.like("Wget/%")),
+        "mod: by size": sa.select(f.id).where(f.size.is_not(None))
+                          .order_by(f.size.desc(), f.id).limit(10000),
+        "mod: by nsfw": sa.select(f.id).where(f.size.is_not(None))
+                          .order_by(f.nsfw_score.desc(), f.id).limit(10000),
+    }
+
+
+def time_queries(engine, qs: dict, rounds: int) -> dict:
+    executed = []
+
+    @sa.event.listens_for(engine, "before_cursor_execute")
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    timings = {}
+    with engine.connect() as conn:
+        for name, q in qs.items():
+            best = float("inf")
+            for _ in range(rounds):
+                start = time.perf_counter()
+                n = len(conn.execute(q).all())
+                best = min(best, time.perf_counter() - start)
+
+            statement, parameters = executed[-1]
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement,
+                                        parameters)
+            timings[name] = (best, n, "; ".join(r[-1] for r in plan))
+
+    sa.event.remove(engine, "before_cursor_execute", capture)
+    return timings
+
+
+def migrate(engine, step: str) -> None:
+    spec = importlib.util.spec_from_file_location("migration", MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+
+    with engine.begin() as conn:
+        with Operations.context(MigrationContext.configure(conn)):
+            getattr(migration, step)()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--plans", action="store_true",
+                        help="show SQLite's query plans")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sa.create_engine(f"sqlite:///{os.path.join(tmp, 'db')}")
+        File.__table__.create(engine)
+        migrate(engine, "downgrade")
+
+        start = time.perf_counter()
+        seed(engine, args.rows, rnd)
+        print(f"Seeded {args.rows} rows in "
+              f"{time.perf_counter() - start:.1f} s")
+
+        with engine.connect() as conn:
+            addr = conn.execute(sa.select(File.__table__.c.addr)
+                                .limit(1)).scalar()
+        qs = queries(addr)
+
+        before = time_queries(engine, qs, args.rounds)
+        start = time.perf_counter()
+        migrate(engine, "upgrade")
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        print(f"Created indexes in {time.perf_counter() - start:.1f} s\n")
+        after = time_queries(engine, qs, args.rounds)
+
+    print(f"{'query':<16}{'rows':>9}{'before ms':>12}{'after ms':>12}"
+          f"{'speedup':>9}")
+    for name in qs:
+        b, n, bplan = before[name]
+        a, _, aplan = after[name]
+        print(f"{name:<16}{n:>9}{b * 1000:>12.1f}{a * 1000:>12.1f}"
+              f"{b / a:>8.1f}x")
+        if args.plans:
+            print(f"    before: {bplan}\n    after:  {aplan}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+    Compares throughput and CPU time of serving large files through
+    send_from_directory against the built-in serve_file.
+
+    Responses are produced in a request context and drained into /dev/null
+    the way a WSGI server would. With a file wrapper (the default), bodies
+    handed to wsgi.file_wrapper are sent with os.sendfile like uWSGI and
+    gunicorn do; --no-file-wrapper simulates a server without one.
+
+        python bench/serve.py --size 512 --rounds 5
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flask import request, send_from_directory  # noqa: E402
+from werkzeug.exceptions import HTTPException  # noqa: E402
+from fhost import app, FileMeta, serve_file, storage_layout  # noqa: E402
+
+
+class SendfileWrapper:
+    """
+    Stands in for a server's wsgi.file_wrapper
+    """
+    def __init__(self, f, blksize=8192):
+        self.f = f
+        self.blksize = blksize
+
+    def __iter__(self):
+        # Only used when werkzeug wraps the body to serve a range
+        while chunk := self.f.read(self.blksize):
+            yield chunk
+
+    def close(self):
+        self.f.close()
+
+
+def drain(app_iter, length: int, sink: int) -> int:
+    total = 0
+    try:
+        if isinstance(app_iter, SendfileWrapper):
+            fd = app_iter.f.fileno()
+            offset = app_iter.f.tell()
+            while total < length:
+                sent = os.sendfile(sink, fd, offset + total, length - total)
+                if not sent:
+                    break
+                total += sent
+        else:
+            for chunk in app_iter:
+                total += os.write(sink, chunk)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return total
+
+
+def run(serve, meta: FileMeta, headers: dict, environ: dict,
+        rounds: int, sink: int) -> tuple[float, float, int, int]:
+    wall = cpu = 0
+    nbytes = 0
+
+    for _ in range(rounds):
+        with app.test_request_context("/", headers=headers,
+                                      environ_overrides=environ):
+            w0, c0 = time.perf_counter(), time.process_time()
+            try:
+                response = serve(meta)
+            except HTTPException as e:
+                response = e.get_response()
+            app_iter = response(request.environ, lambda *a: None)
+            nbytes += drain(app_iter, response.content_length or 0, sink)
+            wall += time.perf_counter() - w0
+            cpu += time.process_time() - c0
+
+    return wall, cpu, nbytes, response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=256,
+                        help="size of the test file in MiB")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--no-file-wrapper", action="store_true",
+                        help="simulate a server without wsgi.file_wrapper")
+    args = parser.parse_args()
+
+    mib = 1024 * 1024
+    size = args.size * mib
+
+    with tempfile.TemporaryDirectory() as storage:
+        h = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=storage, delete=False) as tmp:
+            chunk = os.urandom(mib)
+            for _ in range(args.size):
+                tmp.write(chunk)
+                h.update(chunk)
+
+        digest = h.hexdigest()
+        os.rename(tmp.name, Path(storage) / digest)
+        app.config["FHOST_STORAGE_PATH"] = storage
+        storage_layout.root = Path(storage)
+        storage_layout.fanout = ()
+        meta = FileMeta(1, digest, ".mp4", "video/mp4", size, None, False,
+                        int(time.time() * 1000) + 3600000, True)
+
+        def legacy(meta):
+            return send_from_directory(storage, meta.sha256,
+                                       mimetype=meta.mime, etag=meta.sha256)
+
+        environ = {}
+        if not args.no_file_wrapper:
+            environ["wsgi.file_wrapper"] = SendfileWrapper
+
+        cases = [
+            ("whole file", {}),
+            ("tail range", {"Range": f"bytes={size // 2}-"}),
+            ("middle 16 MiB", {"Range": f"bytes={size // 4}-"
+                                        f"{size // 4 + 16 * mib - 1}"}),
+            ("4 ranges", {"Range": "bytes=" + ",".join(
+                f"{i * size // 4}-{i * size // 4 + mib - 1}"
+                for i in range(4))}),
+        ]
+
+        sink = os.open(os.devnull, os.O_WRONLY)
+        print(f"{'case':<16}{'path':<22}{'status':>7}{'MiB/s':>10}"
+              f"{'CPU s':>10}{'MiB sent':>10}")
+        try:
+            # Warm up the page cache so the first case isn't penalized
+            run(serve_file, meta, {}, environ, 1, sink)
+
+            for name, headers in cases:
+                for label, serve in (("send_from_directory", legacy),
+                                     ("serve_file", serve_file)):
+                    wall, cpu, nbytes, status = run(serve, meta, headers,
+                                                    environ, args.rounds,
+                                                    sink)
+                    print(f"{name:<16}{label:<22}{status:>7}"
+                          f"{nbytes / mib / wall:>10.0f}{cpu:>10.3f}"
+                          f"{nbytes / mib:>10.0f}")
+        finally:
+            os.close(sink)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+    Measures upload latency on SQLite while maintenance writes concurrently.
+
+    A throwaway instance with its own database and storage directory is set
+    up in a temporary directory. Several forked worker processes upload small
+    files through the test client, the way uWSGI workers would, while another
+    process keeps expiring batches of files and running prune on them.
+
+    Compare FHOST_SQLITE_PRAGMAS against SQLite's defaults:
+
+        python bench/sqlite_concurrency.py --workers 8
+        python bench/sqlite_concurrency.py --workers 8 --no-pragmas
+"""
+
+import argparse
+import io
+import multiprocessing
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def setup_instance(tmp: Path, pragmas: bool):
+    """
+    Imports fhost with an instance directory pointing into tmp
+    """
+    root = Path(__file__).resolve().parent.parent
+    (tmp / "fhost.py").symlink_to(root / "fhost.py")
+    (tmp / "templates").symlink_to(root / "templates")
+    (tmp / "instance").mkdir()
+
+    config = [
+        f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp / 'db.sqlite'}'",
+        f"FHOST_STORAGE_PATH = '{tmp / 'up'}'",
+        "FHOST_USE_X_ACCEL_REDIRECT = False",
+        "SERVER_NAME = 'localhost'",
+    ]
+    if not pragmas:
+        config.append("FHOST_SQLITE_PRAGMAS = {}")
+    (tmp / "instance" / "config.py").write_text("\n".join(config) + "\n")
+
+    sys.path.insert(0, str(tmp))
+    import fhost
+
+    with fhost.app.app_context():
+        fhost.db.create_all()
+
+    return fhost
+
+
+def uploader(fhost, uploads: int, size: int, results):
+    fhost.app.logger.disabled = True
+    client = fhost.app.test_client()
+    latencies = []
+    errors = 0
+
+    for _ in range(uploads):
+        data = secrets.token_bytes(size)
+        start = time.perf_counter()
+        r = client.post("/", data={"file": (io.BytesIO(data), "f.bin")})
+        latencies.append(time.perf_counter() - start)
+        if r.status_code != 200:
+            errors += 1
+
+    results.put((latencies, errors))
+
+
+def pruner(fhost, batch: int, pause: float, stop, results):
+    from sqlalchemy import insert
+
+    app, db, File = fhost.app, fhost.db, fhost.File
+    runner = app.test_cli_runner()
+    durations = []
+    failures = 0
+
+    while not stop.is_set():
+        with app.app_context():
+            # Files whose data is already gone, so this measures the
+            # database side of pruning
+            expired = int(time.time() * 1000) - 1
+            db.session.execute(insert(File), [
+                {"sha256": secrets.token_hex(32), "ext": ".bin",
+                 "mime": "application/octet-stream", "size": 1,
+                 "expiration": expired} for _ in range(batch)])
+            db.session.commit()
+
+        start = time.perf_counter()
+        res = runner.invoke(fhost.prune)
+        durations.append(time.perf_counter() - start)
+        if res.exception:
+            failures += 1
+        time.sleep(pause)
+
+    results.put((durations, failures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=200,
+                        help="uploads per worker")
+    parser.add_argument("--size", type=int, default=4096,
+                        help="size of each upload in bytes")
+    parser.add_argument("--prune-batch", type=int, default=2000,
+                        help="files expired before each prune run")
+    parser.add_argument("--prune-pause", type=float, default=0.1,
+                        help="seconds between prune runs")
+    parser.add_argument("--no-pragmas", action="store_true",
+                        help="leave SQLite's default settings")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fhost = setup_instance(Path(tmp), not args.no_pragmas)
+
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        prune_results = ctx.Queue()
+        stop = ctx.Event()
+
+        workers = [ctx.Process(target=uploader,
+                               args=(fhost, args.uploads, args.size, results))
+                   for _ in range(args.workers)]
+        prune_proc = ctx.Process(target=pruner,
+                                 args=(fhost, args.prune_batch,
+                                       args.prune_pause, stop, prune_results))
+
+        start = time.perf_counter()
+        prune_proc.start()
+        for w in workers:
+            w.start()
+
+        latencies = []
+        errors = 0
+        for _ in workers:
+            lat, err = results.get()
+            latencies += lat
+            errors += err
+        wall = time.perf_counter() - start
+
+        stop.set()
+        durations, failures = prune_results.get()
+        for p in workers + [prune_proc]:
+            p.join()
+
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    # The default "exclusive" method extrapolates past the largest sample
+    pct = statistics.quantiles(ms, n=100, method="inclusive")
+
+    print(f"pragmas:      {'off' if args.no_pragmas else 'on'}")
+    print(f"uploads:      {len(ms)} in {wall:.1f} s "
+          f"({len(ms) / wall:.0f}/s), {errors} failed")
+    print(f"latency (ms): p50 {pct[49]:.1f}  p95 {pct[94]:.1f}  "
+          f"p99 {pct[98]:.1f}  max {ms[-1]:.1f}")
+    if durations:
+        print(f"prune:        {len(durations)} runs, mean "
+              f"{statistics.mean(durations) * 1000:.0f} ms, "
+              f"{failures} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,29 +20,42 @@
 
 from flask import Flask, abort, make_response, redirect, render_template, \
     Request, request, Response, send_from_directory, url_for
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from sqlalchemy import and_, or_
+from werkzeug.datastructures import FileStorage, Headers
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
+from sqlalchemy import or_, event, func, select, tuple_, update
 from sqlalchemy.orm import declared_attr
+from sqlalchemy import inspect as sa_inspect, literal as sa_literal
 from sqlalchemy import types
+import sqlalchemy.exc
+import sqlalchemy.orm.exc
 from jinja2.exceptions import *
 from jinja2 import ChoiceLoader, FileSystemLoader
 from hashlib import sha256
-from magic import Magic
 from mimetypes import guess_extension
 import click
 import enum
+import fcntl
+import heapq
+import io
 import os
 import sys
 import time
 import datetime
 import ipaddress
+import logging
+import math
+import mmap
 import typing
-import requests
 import secrets
+import shutil
 import re
-from validators import url as url_valid
+from collections import Counter, OrderedDict
 from pathlib import Path
+import threading
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.update(
@@ -55,6 +68,21 @@ app.config.update(
     USE_X_SENDFILE=False,
     FHOST_USE_X_ACCEL_REDIRECT=True,  # expect nginx by default
     FHOST_STORAGE_PATH="up",
+    FHOST_STORAGE_FANOUT=(),
+    FHOST_PACK_THRESHOLD=0,
+    FHOST_PACK_SEGMENT_SIZE=256 * 1024 * 1024,
+    FHOST_PACK_COMPACT_RATIO=0.5,
+    FHOST_STORAGE_BACKEND="local",
+    FHOST_S3_BUCKET=None,
+    FHOST_S3_PREFIX="",
+    FHOST_S3_ENDPOINT=None,
+    FHOST_S3_REGION=None,
+    FHOST_S3_ACCESS_KEY=None,
+    FHOST_S3_SECRET_KEY=None,
+    FHOST_S3_MAX_CONNECTIONS=10,
+    FHOST_S3_PART_SIZE=16 * 1024 * 1024,
+    FHOST_S3_REDIRECT=True,
+    FHOST_S3_URL_EXPIRY=60 * 60,
     FHOST_MAX_EXT_LENGTH=9,
     FHOST_SECRET_BYTES=16,
     FHOST_EXT_OVERRIDE={
@@ -72,6 +100,10 @@ app.config.update(
     },
     NSFW_DETECT=False,
     NSFW_THRESHOLD=0.92,
+    NSFW_BACKEND="torch",
+    NSFW_ONNX_MODEL=None,
+    NSFW_THREADS=None,
+    NSFW_VIDEO_FRAMES=1,
     VSCAN_SOCKET=None,
     VSCAN_QUARANTINE_PATH="quarantine",
     VSCAN_IGNORE=[
@@ -79,6 +111,32 @@ app.config.update(
         "PUA.Win.Packer.XmMusicFile",
     ],
     VSCAN_INTERVAL=datetime.timedelta(days=7),
+    FHOST_REMOVED_INDEX_INTERVAL=10,
+    FHOST_UPLOAD_SESSION_TTL=24 * 60 * 60 * 1000,
+    FHOST_SPOOL_TTL=60 * 60 * 1000,
+    FHOST_FILE_CACHE_SIZE=10000,
+    FHOST_FILE_CACHE_TTL=30,
+    FHOST_REDIRECT_MAX_AGE=24 * 60 * 60,
+    FHOST_URL_CACHE_SIZE=10000,
+    FHOST_CACHE_STATS_INTERVAL=None,
+    FHOST_MAX_SHORTEN_URLS=100,
+    FHOST_FETCH_TIMEOUT=(5, 30),
+    FHOST_FETCH_MAX_TIME=5 * 60,
+    FHOST_FETCH_POOL_SIZE=10,
+    FHOST_FETCH_MAX_REDIRECTS=5,
+    FHOST_FETCH_ASYNC=False,
+    FHOST_FETCH_MAX_JOBS=100,
+    FHOST_FETCH_MAX_JOBS_PER_ADDR=3,
+    FHOST_FETCH_JOB_TTL=24 * 60 * 60 * 1000,
+    FHOST_FETCH_CACHE_TTL=60 * 60,
+    FHOST_PRUNE_HORIZON=15 * 60,
+    FHOST_ARCHIVE_AFTER=365 * 24 * 60 * 60 * 1000,
+    FHOST_SQLITE_PRAGMAS={
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 10000,
+        "mmap_size": 256 * 1024 * 1024,
+    },
     URL_ALPHABET="DEQhd2uFteibPwq0SWBInTpA_jcZL5GKz3YCR14Ulk87Jors9vNHgfaOmMX"
                  "y6Vx-",
 )
@@ -92,28 +150,623 @@ app.jinja_loader = ChoiceLoader([
 if app.config["DEBUG"]:
     app.config["FHOST_USE_X_ACCEL_REDIRECT"] = False
 
-if app.config["NSFW_DETECT"]:
-    from nsfw_detect import NSFWDetector
-    nsfw = NSFWDetector()
+_mimedetect = None
 
-try:
-    mimedetect = Magic(mime=True, mime_encoding=False)
-except TypeError:
-    print("""Error: You have installed the wrong version of the 'magic' module.
+
+def get_mimedetect():
+    """
+    Returns the libmagic handle, loading its database on first use
+    """
+    global _mimedetect
+
+    if _mimedetect is None:
+        from magic import Magic
+        try:
+            _mimedetect = Magic(mime=True, mime_encoding=False)
+        except TypeError:
+            print("""Error: You have installed the wrong version of the \
+'magic' module.
 Please install python-magic.""")
-    sys.exit(1)
+            sys.exit(1)
+
+    return _mimedetect
+
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Applies FHOST_SQLITE_PRAGMAS to each new SQLite connection
+
+    With WAL, readers and the writer no longer block each other, and with
+    synchronous=NORMAL commits don't wait for the disk. Writers queue up for
+    busy_timeout milliseconds instead of failing right away.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma, value in app.config["FHOST_SQLITE_PRAGMAS"].items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def dispose_after_fork():
+    """
+    Drops database connections inherited from the parent process
+
+    SQLite connections must not be used across fork(). The child's pool is
+    emptied without closing them, so the parent can keep using its own.
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+
+os.register_at_fork(after_in_child=dispose_after_fork)
+
+
+class StorageLayout:
+    """
+    Maps SHA-256 digests to paths in the storage directory
+
+    With a fan-out of e.g. (2, 2), the file abcdef... is stored as
+    ab/cd/abcdef..., which keeps directories small. The .layout file in the
+    storage directory records the fan-out all stored files are known to
+    follow. Until it matches the configured one, files are also looked up
+    where that previous layout put them, so the migrate-layout command can
+    move them while the service is up.
+    """
+    marker = ".layout"
+    marker_interval = 1
+
+    def __init__(self, root: Path, fanout: typing.Iterable[int]):
+        self.root = root
+        self.fanout = tuple(fanout)
+        self._migrated = False
+        self._previous = None
+        self._checked = 0
+
+    def relpath(self, digest: str,
+                fanout: typing.Optional[tuple] = None) -> Path:
+        if fanout is None:
+            fanout = self.fanout
+
+        parts = []
+        pos = 0
+        for n in fanout:
+            parts.append(digest[pos:pos + n])
+            pos += n
+
+        return Path(*parts, digest)
+
+    def path(self, digest: str) -> Path:
+        """
+        Returns where a file is stored in the configured layout
+        """
+        return self.root / self.relpath(digest)
+
+    def read_marker(self) -> tuple:
+        try:
+            text = (self.root / self.marker).read_text().strip()
+        except FileNotFoundError:
+            return ()  # Never migrated, so everything is stored flat
+
+        return tuple(int(n) for n in text.split("/") if n)
+
+    def write_marker(self) -> None:
+        tmp = self.root / f"{self.marker}.tmp"
+        tmp.write_text("/".join(map(str, self.fanout)) + "\n")
+        tmp.replace(self.root / self.marker)
+
+    def previous(self) -> typing.Optional[tuple]:
+        """
+        Returns the fan-out some files may still be stored with
+
+        Returns None once all files follow the configured layout.
+        """
+        if not self._migrated:
+            now = time.monotonic()
+            if now - self._checked >= self.marker_interval:
+                self._checked = now
+                self._previous = self.read_marker()
+                self._migrated = self._previous == self.fanout
+
+        return None if self._migrated else self._previous
+
+    def find(self, digest: str) -> Path:
+        """
+        Returns where a file is stored, or where it should be stored if it
+        doesn't exist
+        """
+        p = self.path(digest)
+        prev = self.previous()
+
+        if prev is None or p.is_file():
+            return p
+
+        old = self.root / self.relpath(digest, prev)
+        # If the file has been moved in the meantime, it's at p now
+        return old if old.is_file() else p
+
+    def is_shard(self, relpath: Path) -> bool:
+        """
+        Checks if relpath is a directory used by the configured layout
+        """
+        parts = relpath.parts
+        return len(parts) <= len(self.fanout) and all(
+            len(part) == n and re.fullmatch(r"[0-9a-f]+", part)
+            for part, n in zip(parts, self.fanout))
+
+
+storage_layout = StorageLayout(Path(app.config["FHOST_STORAGE_PATH"]),
+                               app.config["FHOST_STORAGE_FANOUT"])
+
+
+class PackStore:
+    """
+    Stores small files back to back in large segment files
+
+    This saves an inode and a directory entry per file. Segments are
+    numbered and only ever appended to; the segment and offset of each file
+    are kept in the database. Once a segment reaches segment_size, the next
+    one is started. Space used by expired and removed files is reclaimed by
+    compact_packs(), which prune calls.
+    """
+    def __init__(self, root: Path, segment_size: int):
+        self.root = root
+        self.segment_size = segment_size
+        self._active = None
+
+    def segpath(self, segment: int) -> Path:
+        return self.root / f"{segment:08d}"
+
+    def segments(self) -> list[int]:
+        try:
+            return sorted(int(p.name) for p in self.root.iterdir()
+                          if p.name.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def append(self, data: bytes) -> tuple[int, int]:
+        """
+        Appends data to the active segment
+
+        Returns the segment and offset the data was written at.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        lockfd = os.open(self.root / "lock", os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # Serializes appends between all processes
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+
+            segment = self._active or max(self.segments(), default=1)
+            while self.segpath(segment + 1).exists():
+                segment += 1  # Another process started a new segment
+
+            while True:
+                fd = os.open(self.segpath(segment),
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+                offset = os.fstat(fd).st_size
+                if offset == 0 or \
+                        offset + len(data) <= self.segment_size:
+                    break
+                os.close(fd)
+                segment += 1
+
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+
+            self._active = segment
+            return segment, offset
+        finally:
+            os.close(lockfd)
+
+    def read(self, segment: int, offset: int, size: int) -> bytes:
+        fd = os.open(self.segpath(segment), os.O_RDONLY)
+        try:
+            return os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+
+
+pack_store = PackStore(storage_layout.root / ".pack",
+                       app.config["FHOST_PACK_SEGMENT_SIZE"])
+
+
+class LocalStorage:
+    """
+    Stores files in FHOST_STORAGE_PATH, laid out by storage_layout
+
+    All storage backends provide these methods. Files are identified by
+    their SHA-256 digest. Uploads are always spooled to the local storage
+    directory first, so put() takes an IngestFile.
+    """
+    local = True
+
+    def __init__(self, layout: StorageLayout):
+        self.layout = layout
+
+    def put(self, digest: str, ingest: "IngestFile") -> bool:
+        """
+        Stores a file unless it already exists
+
+        Returns whether the file was created.
+        """
+        return ingest.commit(self.layout.find(digest))
+
+    def open(self, digest: str) -> typing.BinaryIO:
+        return open(self.layout.find(digest), "rb")
+
+    def read_range(self, digest: str, start: int,
+                   end: int) -> typing.Iterator[bytes]:
+        with self.open(digest) as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(SERVE_CHUNK_SIZE, end - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+
+    def delete(self, digest: str) -> None:
+        """
+        Deletes a file, raising FileNotFoundError if it doesn't exist
+        """
+        os.remove(self.layout.find(digest))
+
+    def exists(self, digest: str) -> bool:
+        return self.layout.find(digest).is_file()
+
+    def stat(self, digest: str) -> typing.Optional[int]:
+        """
+        Returns the size of a file, or None if it doesn't exist
+        """
+        try:
+            return self.layout.find(digest).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def iterate(self) -> typing.Iterator[str]:
+        """
+        Yields the digests of all stored files
+        """
+        digest_re = re.compile(r"[0-9a-f]{64}")
+        for dirpath, dirnames, filenames in os.walk(self.layout.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            yield from filter(digest_re.fullmatch, filenames)
+
+    def locate(self, digest: str) -> str:
+        """
+        Returns a path or URL that tools like mpv and FFmpeg can open
+        """
+        return str(self.layout.find(digest))
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    A seekable file object reading an object with ranged GET requests
+
+    Use it through a BufferedReader, so small reads don't each cause a
+    request.
+    """
+    def __init__(self, backend: "S3Storage", key: str, size: int):
+        self.backend = backend
+        self.key = key
+        self.size = size
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos,
+                io.SEEK_END: self.size}[whence]
+        self.pos = max(base + offset, 0)
+        return self.pos
+
+    def _get(self, n: int) -> bytes:
+        end = min(self.pos + n, self.size)
+        if self.pos >= end:
+            return b""
+
+        obj = self.backend.client.get_object(
+            Bucket=self.backend.bucket, Key=self.key,
+            Range=f"bytes={self.pos}-{end - 1}")
+        try:
+            data = obj["Body"].read()
+        finally:
+            obj["Body"].close()
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self._get(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readall(self) -> bytes:
+        return self._get(self.size - self.pos)
+
+
+class S3Storage:
+    """
+    Stores files in a bucket of an S3-compatible object store
+
+    Objects are named after their digest, optionally with a prefix. Large
+    files are uploaded in parts of FHOST_S3_PART_SIZE. Each process has its
+    own client with a pool of up to FHOST_S3_MAX_CONNECTIONS connections,
+    as clients must not be shared across fork().
+    """
+    local = False
+
+    def __init__(self, bucket: str, prefix: str = "",
+                 endpoint: typing.Optional[str] = None,
+                 region: typing.Optional[str] = None,
+                 access_key: typing.Optional[str] = None,
+                 secret_key: typing.Optional[str] = None,
+                 max_connections: int = 10,
+                 part_size: int = 16 * 1024 * 1024):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint = endpoint
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_connections = max_connections
+        self.part_size = part_size
+        self._client = None
+        self._pid = None
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            import boto3
+            from botocore.config import Config
+
+            self._client = boto3.client(
+                "s3", endpoint_url=self.endpoint, region_name=self.region,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                config=Config(max_pool_connections=self.max_connections,
+                              retries={"mode": "standard"}))
+            self._pid = os.getpid()
+
+        return self._client
+
+    def key(self, digest: str) -> str:
+        return self.prefix + digest
+
+    def put(self, digest: str, ingest: "IngestFile") -> bool:
+        from boto3.s3.transfer import TransferConfig
+
+        if self.exists(digest):
+            return False
+
+        ingest.flush()
+        config = TransferConfig(multipart_threshold=self.part_size,
+                                multipart_chunksize=self.part_size,
+                                max_concurrency=self.max_connections)
+        with open(ingest.path, "rb") as f:
+            self.client.upload_fileobj(f, self.bucket, self.key(digest),
+                                       Config=config)
+        return True
+
+    def open(self, digest: str) -> typing.BinaryIO:
+        size = self.stat(digest)
+        if size is None:
+            raise FileNotFoundError(self.key(digest))
+
+        return io.BufferedReader(S3RangeReader(self, self.key(digest), size),
+                                 buffer_size=1024 * 1024)
+
+    def read_range(self, digest: str, start: int,
+                   end: int) -> typing.Iterator[bytes]:
+        obj = self.client.get_object(Bucket=self.bucket,
+                                     Key=self.key(digest),
+                                     Range=f"bytes={start}-{end - 1}")
+        try:
+            yield from obj["Body"].iter_chunks(SERVE_CHUNK_SIZE)
+        finally:
+            obj["Body"].close()
+
+    def delete(self, digest: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(digest))
+
+    def exists(self, digest: str) -> bool:
+        return self.stat(digest) is not None
+
+    def stat(self, digest: str) -> typing.Optional[int]:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket,
+                                           Key=self.key(digest))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+        return head["ContentLength"]
+
+    def iterate(self) -> typing.Iterator[str]:
+        digest_re = re.compile(r"[0-9a-f]{64}")
+        pages = self.client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=self.prefix)
+
+        for page in pages:
+            for obj in page.get("Contents", []):
+                digest = obj["Key"][len(self.prefix):]
+                if digest_re.fullmatch(digest):
+                    yield digest
+
+    def presign(self, digest: str, mime: typing.Optional[str] = None,
+                expiry: int = 3600) -> str:
+        """
+        Returns a URL anyone can download the file from for expiry seconds
+        """
+        params = {"Bucket": self.bucket, "Key": self.key(digest)}
+        if mime:
+            params["ResponseContentType"] = mime
+
+        return self.client.generate_presigned_url("get_object", params,
+                                                  ExpiresIn=expiry)
+
+    def locate(self, digest: str) -> str:
+        return self.presign(digest, expiry=app.config["FHOST_S3_URL_EXPIRY"])
+
+
+match app.config["FHOST_STORAGE_BACKEND"]:
+    case "local":
+        storage_backend = LocalStorage(storage_layout)
+    case "s3":
+        storage_backend = S3Storage(app.config["FHOST_S3_BUCKET"],
+                                    app.config["FHOST_S3_PREFIX"],
+                                    app.config["FHOST_S3_ENDPOINT"],
+                                    app.config["FHOST_S3_REGION"],
+                                    app.config["FHOST_S3_ACCESS_KEY"],
+                                    app.config["FHOST_S3_SECRET_KEY"],
+                                    app.config["FHOST_S3_MAX_CONNECTIONS"],
+                                    app.config["FHOST_S3_PART_SIZE"])
+    case backend:
+        raise ValueError(f"Unknown FHOST_STORAGE_BACKEND: {backend}")
+
+
+class IngestFile:
+    """
+    Spools an uploaded file into the storage directory as it is received
+
+    The data is hashed and measured while it is written, and the first
+    sniff_size bytes are kept around for MIME type detection, so nothing
+    has to read the file again before it is stored. Since the spool lives
+    in the storage directory, storing it is a rename. If the file is closed
+    without having been committed, the spool is removed. Spools of workers
+    that died are removed by prune_cleanup.
+    """
+    sniff_size = 1024 * 1024
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f".ingest-{secrets.token_hex(16)}"
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+        self._file = os.fdopen(fd, "w+b")
+        self._hasher = sha256()
+        self._committed = False
+        self.head = bytearray()
+        self.size = 0
+
+    @staticmethod
+    def from_stream(stream: typing.BinaryIO, directory: Path):
+        ingest = IngestFile(directory)
+        for chunk in iter(lambda: stream.read(65536), b""):
+            ingest.write(chunk)
+        ingest.seek(0)
+        return ingest
+
+    @staticmethod
+    def resume(path: Path, size: int, hasher=None):
+        """
+        Adopts an existing spool that has been written to elsewhere
+
+        Unless a hash object covering all of its data is passed in, the
+        spool is read once to hash it.
+        """
+        ingest = IngestFile.__new__(IngestFile)
+        ingest.path = path
+        ingest._file = open(path, "r+b")
+        ingest._committed = False
+        ingest.head = bytearray(ingest._file.read(IngestFile.sniff_size))
+        ingest.size = size
+
+        if hasher is None:
+            hasher = sha256(ingest.head)
+            for chunk in iter(lambda: ingest._file.read(65536), b""):
+                hasher.update(chunk)
+        ingest._hasher = hasher
+        ingest._file.seek(0)
+
+        return ingest
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def write(self, data) -> int:
+        self._hasher.update(data)
+        self.size += len(data)
+        if len(self.head) < self.sniff_size:
+            self.head += data[:self.sniff_size - len(self.head)]
+        return self._file.write(data)
+
+    @property
+    def digest(self) -> str:
+        return self._hasher.hexdigest()
+
+    def commit(self, dest: Path) -> bool:
+        """
+        Atomically moves the spooled data to dest
+
+        If dest already exists, it holds the same data, so the spool is left
+        to be discarded on close. Returns whether dest was created.
+        """
+        self._file.flush()
+        if dest.is_file():
+            return False
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        self.path.replace(dest)
+        self._committed = True
+        return True
+
+    def close(self) -> None:
+        self._file.close()
+        if not self._committed:
+            self.path.unlink(missing_ok=True)
+
+
+class FhostRequest(Request):
+    """
+    Streams uploaded files straight into IngestFile spools
+
+    Spools are also tracked here so they get cleaned up if parsing the
+    request body fails halfway through, e.g. by exceeding
+    MAX_CONTENT_LENGTH.
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        ingest = IngestFile(Path(app.config["FHOST_STORAGE_PATH"]))
+        self.__dict__.setdefault("ingest_files", []).append(ingest)
+        return ingest
+
+    def close(self) -> None:
+        super().close()
+        for ingest in self.__dict__.get("ingest_files", []):
+            ingest.close()
+
+
+app.request_class = FhostRequest
+
+
 class URL(db.Model):
     __tablename__ = "URL"
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.UnicodeText, unique=True)
+    sha256 = db.Column(db.String(64), unique=True, index=True)
 
     def __init__(self, url):
         self.url = url
+        self.sha256 = URL.hash(url)
 
     def getname(self):
         return su.enbase(self.id)
@@ -121,16 +774,50 @@ class URL(db.Model):
     def geturl(self):
         return url_for("get", path=self.getname(), _external=True) + "\n"
 
+    @staticmethod
+    def hash(url: str) -> str:
+        return sha256(url.encode()).hexdigest()
+
     @staticmethod
     def get(url):
-        u = URL.query.filter_by(url=url).first()
+        return URL.get_many([url])[0]
 
-        if not u:
-            u = URL(url)
-            db.session.add(u)
-            db.session.commit()
+    """
+    Returns URL objects for all given URLs, in order, adding missing ones
+
+    Missing URLs are inserted with a single statement that skips URLs added
+    concurrently by someone else, so racing requests for the same URL
+    don't fail. Lookups use the fixed-width hash index.
+    """
+    @staticmethod
+    def get_many(urls: list[str]) -> list:
+        hashes = {url: URL.hash(url) for url in urls}
+        rows = [{"url": url, "sha256": h} for url, h in hashes.items()]
+
+        match db.engine.dialect.name:
+            case "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            case "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            case _:
+                insert = None
+
+        if insert is not None:
+            db.session.execute(
+                insert(URL).values(rows).on_conflict_do_nothing())
+        else:
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(URL.__table__.insert(), row)
+                except sqlalchemy.exc.IntegrityError:
+                    pass  # Already there
+
+        db.session.commit()
 
-        return u
+        known = {u.sha256: u for u in
+                 URL.query.filter(URL.sha256.in_(hashes.values()))}
+        return [known[hashes[url]] for url in urls]
 
 
 class IPAddress(types.TypeDecorator):
@@ -155,20 +842,58 @@ class IPAddress(types.TypeDecorator):
         return value
 
 
+def pattern_index(table: str, column: str) -> db.Index:
+    """
+    Returns an index that LIKE filters on a column can use
+
+    LIKE is case-insensitive in SQLite, so only an index with the NOCASE
+    collation can serve it. PostgreSQL needs the pattern operator class.
+    This has to match the migration creating the index.
+
+    Alembic can't tell these apart from plain indexes when reflecting them,
+    so migrations/env.py leaves them out of autogenerate.
+    """
+    with app.app_context():
+        dialect = db.engine.dialect.name
+
+    info = {"skip_autogenerate": True}
+
+    if dialect == "sqlite":
+        return db.Index(f"ix_{table}_{column}",
+                        db.text(f"{column} COLLATE NOCASE"), info=info)
+
+    return db.Index(f"ix_{table}_{column}", column, info=info,
+                    postgresql_ops={column: "text_pattern_ops"})
+
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sha256 = db.Column(db.String, unique=True)
     ext = db.Column(db.UnicodeText)
     mime = db.Column(db.UnicodeText)
-    addr = db.Column(IPAddress(16))
+    addr = db.Column(IPAddress(16), index=True)
     ua = db.Column(db.UnicodeText)
     removed = db.Column(db.Boolean, default=False)
-    nsfw_score = db.Column(db.Float)
+    nsfw_score = db.Column(db.Float, index=True)
     expiration = db.Column(db.BigInteger)
+    expired_at = db.Column(db.BigInteger, index=True)
     mgmt_token = db.Column(db.String)
     secret = db.Column(db.String)
     last_vscan = db.Column(db.DateTime)
-    size = db.Column(db.BigInteger)
+    size = db.Column(db.BigInteger, index=True)
+    pack_segment = db.Column(db.Integer, index=True)
+    pack_offset = db.Column(db.BigInteger)
+
+    # Matched to the queries of prune, vscan and the moderation interface
+    __table_args__ = (
+        db.Index("ix_file_expiration", "expiration",
+                 sqlite_where=db.text("expiration IS NOT NULL"),
+                 postgresql_where=db.text("expiration IS NOT NULL")),
+        db.Index("ix_file_removed_last_vscan", "removed", "last_vscan"),
+        pattern_index("file", "mime"),
+        pattern_index("file", "ext"),
+        pattern_index("file", "ua"),
+    )
 
     def __init__(self, sha256, ext, mime, addr, ua, expiration, mgmt_token):
         self.sha256 = sha256
@@ -196,13 +921,51 @@ class File(db.Model):
                        _external=True, _anchor=a) + "\n"
 
     def getpath(self) -> Path:
-        return Path(app.config["FHOST_STORAGE_PATH"]) / self.sha256
+        """
+        Returns the path of the file with the local storage backend
+        """
+        return storage_layout.find(self.sha256)
+
+    def exists(self) -> bool:
+        if self.pack_segment is not None:
+            return pack_store.segpath(self.pack_segment).is_file()
+        return storage_backend.exists(self.sha256)
+
+    def open(self) -> typing.BinaryIO:
+        """
+        Opens the stored file for reading, wherever it is stored
+        """
+        if self.pack_segment is not None:
+            return io.BytesIO(pack_store.read(self.pack_segment,
+                                              self.pack_offset, self.size))
+        return storage_backend.open(self.sha256)
+
+    def locate(self) -> str:
+        """
+        Returns a path or URL that tools like mpv and FFmpeg can open
+
+        Not available for packed files, use open() for those.
+        """
+        return storage_backend.locate(self.sha256)
+
+    def unstore(self) -> None:
+        if self.pack_segment is not None:
+            # The space is reclaimed when the segment is compacted
+            self.pack_segment = None
+            self.pack_offset = None
+        else:
+            try:
+                storage_backend.delete(self.sha256)
+            except FileNotFoundError:
+                pass
 
     def delete(self, permanent=False):
+        if self.expiration is not None:
+            self.expired_at = time.time() * 1000
         self.expiration = None
         self.mgmt_token = None
         self.removed = permanent
-        self.getpath().unlink(missing_ok=True)
+        self.unstore()
 
     """
     Returns the epoch millisecond that a file should expire
@@ -247,18 +1010,110 @@ class File(db.Model):
     """
     @staticmethod
     def store(file_, requested_expiration: typing.Optional[int], addr, ua,
-              secret: bool):
-        fstream = file_.stream
-        hasher = sha256()
-        for chunk in iter(lambda: fstream.read(4096), b""):
-            hasher.update(chunk)
-        digest = hasher.hexdigest()
-        fstream.seek(0, os.SEEK_END)
-        flen = fstream.tell()
-        fstream.seek(0)
+              secret: bool, expected_digest: typing.Optional[str] = None):
+        return File.store_many([file_], requested_expiration, addr, ua,
+                               secret, expected_digest)[0]
+
+    """
+    Stores several files at once
+
+    All files share the same expiration request and secret option. Existing
+    files are looked up with a single query, and all of them are committed
+    in a single transaction, so either all of them are stored or none are.
+    If expected_digest is given, the first file has to match it.
+
+    Returns a list of (File, isnew) tuples in the same order as files.
+    """
+    @staticmethod
+    def store_many(files: list, requested_expiration: typing.Optional[int],
+                   addr, ua, secret: bool,
+                   expected_digest: typing.Optional[str] = None) -> list:
+        storage = Path(app.config["FHOST_STORAGE_PATH"])
+        ingests = []
+
+        try:
+            for file_ in files:
+                if isinstance(file_.stream, IngestFile):
+                    ingests.append(file_.stream)
+                else:
+                    ingests.append(IngestFile.from_stream(file_.stream,
+                                                          storage))
+
+            if expected_digest is not None and \
+                    ingests[0].digest != expected_digest:
+                abort(400, "Checksum mismatch.")
+
+            for ingest in ingests:
+                if removed_index.is_removed(ingest.digest):
+                    # The file was removed by moderation, so don't accept it
+                    abort(451)
+
+            digests = {ingest.digest for ingest in ingests}
+
+            # If someone else stores one of the files at the same time, or
+            # db-compact archives it, committing fails, but trying again
+            # finds their File
+            for attempt in range(2):
+                known = {f.sha256: f for f in
+                         File.query.filter(File.sha256.in_(digests))}
+
+                if len(known) < len(digests):
+                    # Files that expired long ago are only in the archive
+                    for a in FileArchive.query.filter(
+                            FileArchive.sha256.in_(digests - known.keys())):
+                        known[a.sha256] = a.restore()
+
+                results = []
+                for ingest, file_ in zip(ingests, files):
+                    f, isnew = File._store(ingest, file_,
+                                           known.get(ingest.digest),
+                                           requested_expiration, addr, ua,
+                                           secret)
+                    known[f.sha256] = f
+                    results.append((f, isnew))
+
+                # Only store the data once all files have been accepted.
+                # Should that or committing fail, data created here is
+                # removed again.
+                put = []
+                try:
+                    for (f, isnew), ingest in zip(results, ingests):
+                        if File._put(f, ingest):
+                            put.append(f.sha256)
+
+                    if app.config["NSFW_DETECT"]:
+                        # Scoring happens in the background, see nsfw_worker
+                        db.session.flush()
+                        for f, isnew in results:
+                            if f.nsfw_score is None:
+                                db.session.merge(NSFWJob(f.id))
+
+                    db.session.commit()
+                    return results
+                except (sqlalchemy.exc.IntegrityError,
+                        sqlalchemy.orm.exc.StaleDataError):
+                    # The other upload's File refers to the same data
+                    db.session.rollback()
+                    if attempt:
+                        raise
+                except BaseException:
+                    db.session.rollback()
+                    File._discard(put)
+                    raise
+        finally:
+            for ingest, file_ in zip(ingests, files):
+                if ingest is not file_.stream:
+                    ingest.close()
+
+    @staticmethod
+    def _store(ingest: IngestFile, file_, f,
+               requested_expiration: typing.Optional[int], addr, ua,
+               secret: bool):
+        digest = ingest.digest
+        flen = ingest.size
 
         def get_mime():
-            guess = mimedetect.from_descriptor(fstream.fileno())
+            guess = get_mimedetect().from_buffer(bytes(ingest.head))
             app.logger.debug(f"MIME - specified: '{file_.content_type}' - "
                              f"detected: '{guess}'")
 
@@ -272,9 +1127,9 @@ class File(db.Model):
             if len(mime) > 128:
                 abort(400)
 
-            for flt in MIMEFilter.query.all():
-                if flt.check(guess):
-                    abort(403, flt.reason)
+            flt = request_filters().match_mime(guess)
+            if flt:
+                abort(403, flt.reason)
 
             if mime.startswith("text/") and "charset" not in mime:
                 mime += "; charset=utf-8"
@@ -304,7 +1159,6 @@ class File(db.Model):
         expiration = File.get_expiration(requested_expiration, flen)
         isnew = True
 
-        f = File.query.filter_by(sha256=digest).first()
         if f:
             # If the file already exists
             if f.removed:
@@ -316,6 +1170,12 @@ class File(db.Model):
 
                 # Also generate a new management token
                 f.mgmt_token = secrets.token_urlsafe()
+                f.expired_at = None
+
+                if f.mime is None:
+                    # Restored from the archive, which doesn't keep these
+                    f.mime = get_mime()
+                    f.ext = get_ext(f.mime)
             else:
                 # The file already exists, update the expiration if needed
                 f.expiration = max(f.expiration, expiration)
@@ -335,21 +1195,308 @@ class File(db.Model):
                 f.secret = \
                     secrets.token_urlsafe(app.config["FHOST_SECRET_BYTES"])
 
-        storage = Path(app.config["FHOST_STORAGE_PATH"])
-        storage.mkdir(parents=True, exist_ok=True)
-        p = storage / digest
+        f.size = flen
 
-        if not p.is_file():
-            file_.save(p)
+        db.session.add(f)
+        return f, isnew
 
-        f.size = flen
+    @staticmethod
+    def _put(f, ingest: IngestFile) -> bool:
+        """
+        Stores the data of a file accepted by _store, unless it is packed
+
+        Returns whether this created it in the storage backend.
+        """
+        if f.pack_segment is not None:
+            return False
+
+        if ingest.size < app.config["FHOST_PACK_THRESHOLD"] \
+                and ingest.size == len(ingest.head) \
+                and storage_backend.local \
+                and not storage_backend.exists(f.sha256):
+            # Left unused if the transaction fails, until compacted
+            f.pack_segment, f.pack_offset = \
+                pack_store.append(bytes(ingest.head))
+            return False
+
+        return storage_backend.put(f.sha256, ingest)
 
-        if not f.nsfw_score and app.config["NSFW_DETECT"]:
-            f.nsfw_score = nsfw.detect(str(p))
+    @staticmethod
+    def _discard(digests: list) -> None:
+        """
+        Deletes data put by a failed upload
+
+        Another upload of the same file may have committed its File in the
+        meantime, relying on the data already being there, so that is
+        checked first.
+        """
+        if not digests:
+            return
+
+        used = {f.sha256 for f in File.query.filter(
+            File.sha256.in_(digests), File.removed.is_not(True),
+            File.expiration.is_not(None), File.pack_segment.is_(None))}
+        db.session.rollback()
+
+        for digest in set(digests) - used:
+            try:
+                storage_backend.delete(digest)
+            except FileNotFoundError:
+                pass
+
+    """
+    Looks up stored content by its SHA-256 digest and size
+
+    This lets clients skip uploading files we already have. Returns None if
+    the content has to be uploaded: when it isn't stored, has expired, or
+    the file is secret, since knowing the hash of a secret file must not
+    be enough to obtain its URL.
+
+    Otherwise, expiration is handled the same way as re-uploading the file
+    with store() would.
+    """
+    @staticmethod
+    def store_by_hash(digest: str, size: int,
+                      requested_expiration: typing.Optional[int], addr, ua):
+        if removed_index.is_removed(digest):
+            abort(451)
+
+        f = File.query.filter_by(sha256=digest).first()
+
+        if not f:
+            return None
+        if f.removed:
+            # The file was removed by moderation, so don't accept it back
+            abort(451)
+        if (f.expiration is None or f.secret or f.size != size
+                or not f.exists()):
+            return None
+
+        expiration = File.get_expiration(requested_expiration, size)
+        f.expiration = max(f.expiration, expiration)
+        f.addr = addr
+        f.ua = ua
 
-        db.session.add(f)
         db.session.commit()
-        return f, isnew
+        return f
+
+
+class FileArchive(db.Model):
+    """
+    What is left of a file that expired long ago, see db_compact
+
+    Only what's needed to refuse banned files and to give files that are
+    uploaded again their old ID back is kept.
+    """
+    __tablename__ = "file_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sha256 = db.Column(db.String, unique=True, nullable=False)
+    removed = db.Column(db.Boolean, nullable=False, default=False)
+
+    def restore(self) -> File:
+        """
+        Moves the file back into the file table, without any metadata
+        """
+        f = File(self.sha256, None, None, None, None, None, None)
+        f.id = self.id
+        f.removed = self.removed
+        db.session.delete(self)
+        db.session.add(f)
+        return f
+
+
+class NSFWJob(db.Model):
+    """
+    A file waiting to be scored by the NSFW detector
+    """
+    __tablename__ = "nsfw_job"
+    file_id = db.Column(db.Integer, db.ForeignKey("file.id"),
+                        primary_key=True)
+    queued = db.Column(db.BigInteger)
+
+    def __init__(self, file_id: int):
+        self.file_id = file_id
+        self.queued = time.time() * 1000
+
+
+class UploadSession(db.Model):
+    """
+    A resumable upload in progress
+
+    Chunks are written straight into a spool in the storage directory at the
+    offset the client specifies, so they may arrive in any order and in
+    parallel. Each received chunk is recorded as an UploadChunk.
+    """
+    __tablename__ = "upload_session"
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String, unique=True, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    filename = db.Column(db.UnicodeText)
+    mime = db.Column(db.UnicodeText)
+    requested_expiration = db.Column(db.BigInteger)
+    secret = db.Column(db.Boolean, default=False)
+    addr = db.Column(IPAddress(16))
+    ua = db.Column(db.UnicodeText)
+    updated = db.Column(db.BigInteger)
+    chunks = db.relationship("UploadChunk", order_by="UploadChunk.offset",
+                             cascade="all, delete-orphan")
+
+    def __init__(self, size, filename, mime, requested_expiration, secret,
+                 addr, ua):
+        self.token = secrets.token_urlsafe()
+        self.size = size
+        self.filename = filename
+        self.mime = mime
+        self.requested_expiration = requested_expiration
+        self.secret = secret
+        self.addr = addr
+        self.ua = ua
+        self.updated = time.time() * 1000
+
+    def getpath(self) -> Path:
+        return Path(app.config["FHOST_STORAGE_PATH"]) / \
+            f".upload-{self.token}"
+
+    def geturl(self):
+        return url_for("upload_chunk", token=self.token, _external=True)
+
+    @property
+    def offset(self) -> int:
+        """
+        Returns how many bytes have been received from the start of the file
+        """
+        offset = 0
+        for c in self.chunks:
+            if c.offset > offset:
+                break
+            offset = max(offset, c.offset + c.length)
+        return offset
+
+    def delete(self):
+        self.getpath().unlink(missing_ok=True)
+        _upload_hashers.pop(self.token, None)
+        db.session.delete(self)
+
+
+class UploadChunk(db.Model):
+    __tablename__ = "upload_chunk"
+    session_id = db.Column(db.Integer, db.ForeignKey("upload_session.id"),
+                           primary_key=True)
+    offset = db.Column(db.BigInteger, primary_key=True)
+    length = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String, nullable=False)
+
+
+class UploadHash(typing.NamedTuple):
+    """
+    Running SHA-256 state of a resumable upload
+
+    Covers the chunks listed, as (offset, length, sha256) tuples, which
+    were received in order and without gaps up to end.
+    """
+    end: int
+    hasher: typing.Any
+    chunks: tuple
+    touched: float
+
+
+"""
+Running SHA-256 state of resumable uploads, by session token
+
+hashlib objects can't be shared between processes, so a worker can only
+extend this if it is the one that received the preceding chunk. The state
+is only used to finish an upload if the chunks recorded in the database are
+exactly the ones it covers. Otherwise, e.g. if parts were sent again, the
+spool has to be hashed again. Entries of abandoned uploads are dropped
+after FHOST_UPLOAD_SESSION_TTL.
+"""
+_upload_hashers: dict[str, UploadHash] = {}
+
+
+class FetchJob(db.Model):
+    """
+    A remote file being fetched in the background
+
+    Jobs are queued by URL uploads that ask for it and processed by the
+    fetch worker, which records its progress here so any web worker can
+    report it. Once done, the job refers to the stored file, or holds the
+    status code and message the upload failed with.
+    """
+    __tablename__ = "fetch_job"
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String, unique=True, nullable=False)
+    url = db.Column(db.UnicodeText, nullable=False)
+    secret = db.Column(db.Boolean, default=False)
+    addr = db.Column(IPAddress(16), index=True)
+    ua = db.Column(db.UnicodeText)
+    state = db.Column(db.String(8), nullable=False, index=True)
+    received = db.Column(db.BigInteger, default=0)
+    size = db.Column(db.BigInteger)
+    file_id = db.Column(db.Integer, db.ForeignKey("file.id"))
+    file = db.relationship("File")
+    new = db.Column(db.Boolean, default=False)
+    code = db.Column(db.Integer)
+    error = db.Column(db.UnicodeText)
+    updated = db.Column(db.BigInteger)
+
+    def __init__(self, url, secret, addr, ua):
+        self.token = secrets.token_urlsafe()
+        self.url = url
+        self.secret = secret
+        self.addr = addr
+        self.ua = ua
+        self.state = "queued"
+        self.received = 0
+        self.updated = time.time() * 1000
+
+    def geturl(self):
+        return url_for("fetch_status", token=self.token, _external=True)
+
+    @staticmethod
+    def pending():
+        """
+        Returns a query for all jobs that haven't finished yet
+        """
+        return FetchJob.query.filter(FetchJob.state.in_(("queued",
+                                                         "running")))
+
+
+class RemoteFile(db.Model):
+    """
+    What a remote URL pointed to when it was last fetched
+
+    Along with the digest of the file, the validators the origin sent are
+    kept, so fetching the URL again can be made conditional.
+    """
+    __tablename__ = "remote_file"
+    url_hash = db.Column(db.String(64), primary_key=True)
+    url = db.Column(db.UnicodeText, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    etag = db.Column(db.UnicodeText)
+    last_modified = db.Column(db.UnicodeText)
+    fetched = db.Column(db.BigInteger, nullable=False)
+
+    @staticmethod
+    def get(url: str):
+        return db.session.get(RemoteFile, URL.hash(url))
+
+    @staticmethod
+    def record(url: str, f, headers) -> None:
+        """
+        Remembers that url pointed to the stored File f
+
+        headers are the ones the origin responded with.
+        """
+        try:
+            db.session.merge(RemoteFile(
+                url_hash=URL.hash(url), url=url, sha256=f.sha256,
+                size=f.size, etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+                fetched=time.time() * 1000))
+            db.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            db.session.rollback()  # Recorded concurrently by someone else
 
 
 class RequestFilter(db.Model):
@@ -473,24 +1620,542 @@ class UAFilter(HasRegex, RequestFilter):
         return "User agent not allowed."
 
 
-class UrlEncoder(object):
-    def __init__(self, alphabet, min_length):
-        self.alphabet = alphabet
-        self.min_length = min_length
+class Generation(db.Model):
+    """
+    Counters that are bumped whenever the data they are named after changes
 
-    def enbase(self, x):
-        n = len(self.alphabet)
-        str = ""
-        while x > 0:
-            str = (self.alphabet[int(x % n)]) + str
-            x = int(x // n)
-        padding = self.alphabet[0] * (self.min_length - len(str))
-        return '%s%s' % (padding, str)
+    Workers keep compiled copies of some tables in memory. Checking a
+    counter is a lot cheaper than reloading a table, so they only reload it
+    once its counter has moved.
+    """
+    __tablename__ = "generation"
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
 
-    def debase(self, x):
-        n = len(self.alphabet)
-        result = 0
-        for i, c in enumerate(reversed(x)):
+    @staticmethod
+    def get(name: str) -> int:
+        return db.session.scalar(
+            select(Generation.value).where(Generation.name == name)) or 0
+
+    @staticmethod
+    def bump(name: str, connection) -> None:
+        stmt = update(Generation).where(Generation.name == name) \
+            .values(value=Generation.value + 1)
+        if not connection.execute(stmt).rowcount:
+            connection.execute(
+                Generation.__table__.insert().values(name=name, value=1))
+
+
+@event.listens_for(db.session, "before_flush")
+def bump_generations(session, flush_context, instances):
+    changed = set()
+    prune_soon = (time.time() + app.config["FHOST_PRUNE_HORIZON"]) * 1000
+
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, RequestFilter):
+            changed.add("request_filter")
+        elif isinstance(obj, File):
+            if obj.id is not None:
+                file_cache.invalidate(obj.id)
+                if obj in session.new:
+                    # Restored from the archive under its old ID, which
+                    # other workers may have cached as missing
+                    changed.add("restored")
+            if obj.expiration is not None and \
+                    obj.expiration < prune_soon and \
+                    sa_inspect(obj).attrs.expiration.history.added:
+                # The prune daemon needs to know, see prune_daemon
+                changed.add("expiration")
+            if obj.expiration is None and \
+                    any(sa_inspect(obj).attrs.expiration.history.deleted):
+                # Deleted before its time, see RemovedIndex.refresh
+                changed.add("deleted")
+            if obj.removed and \
+                    True in sa_inspect(obj).attrs.removed.history.added:
+                removed_index.add(obj.sha256)
+                changed.add("removed")
+
+    for name in changed:
+        Generation.bump(name, session.connection())
+
+
+class BloomFilter:
+    """
+    Compact set of SHA-256 digests that may report false positives
+
+    The digests are uniformly distributed already, so instead of hashing
+    them again, bit positions are taken from 32-bit slices of the digest.
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(capacity, 1024)
+        self.size = math.ceil(-self.capacity * math.log(error_rate)
+                              / math.log(2) ** 2)
+        self.hashes = min(8, max(1, round(self.size / self.capacity
+                                          * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: str) -> typing.Iterator[int]:
+        d = bytes.fromhex(digest)
+        for i in range(self.hashes):
+            yield int.from_bytes(d[i * 4:i * 4 + 4], "big") % self.size
+
+    def add(self, digest: str) -> None:
+        for p in self._positions(digest):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, digest: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(digest))
+
+
+class RemovedIndex:
+    """
+    Per-worker index of the digests of files removed by moderation
+
+    Files banned in this process are added right away. Bans from other
+    processes, like the moderation UI or vscan, bump the "removed"
+    generation counter, which is checked at most every
+    FHOST_REMOVED_INDEX_INTERVAL seconds, causing a reload.
+
+    Bans and files deleted before their expiration also clear the file
+    cache, so other workers stop serving them at the same time. So do files
+    restored from the archive, whose IDs might be cached as missing.
+
+    Digests that are not in the index are known not to be banned without
+    asking the database. Positive results are confirmed with an exact query.
+    """
+    def __init__(self):
+        self.bloom = None
+        self.generation = None
+        self.forgotten = None
+        self.checked = 0
+
+    def load(self) -> None:
+        generation = Generation.get("removed")
+        digests = db.session.scalars(
+            select(File.sha256).where(File.removed).union_all(
+                select(FileArchive.sha256).where(FileArchive.removed))).all()
+
+        bloom = BloomFilter(2 * len(digests))
+        for digest in digests:
+            bloom.add(digest)
+
+        self.bloom = bloom
+        self.generation = generation
+        self.checked = time.monotonic()
+
+    def refresh(self) -> None:
+        if self.bloom is None:
+            self.forgotten = self.forget_generations()
+            return self.load()
+
+        now = time.monotonic()
+        if now - self.checked >= app.config["FHOST_REMOVED_INDEX_INTERVAL"]:
+            self.checked = now
+            if Generation.get("removed") != self.generation:
+                # Cached metadata might still allow serving banned files
+                file_cache.clear()
+                self.load()
+            elif self.bloom.count > self.bloom.capacity:
+                self.load()
+
+            forgotten = self.forget_generations()
+            if forgotten != self.forgotten:
+                self.forgotten = forgotten
+                file_cache.clear()
+
+    @staticmethod
+    def forget_generations() -> tuple:
+        """
+        Generations that invalidate the file cache of all workers
+        """
+        return (Generation.get("deleted"), Generation.get("restored"))
+
+    def add(self, digest: str) -> None:
+        if self.bloom is not None:
+            self.bloom.add(digest)
+
+    def is_removed(self, digest: str) -> bool:
+        self.refresh()
+
+        if digest not in self.bloom:
+            return False
+
+        removed = db.session.scalar(
+            select(File.removed).where(File.sha256 == digest))
+        if removed is None:
+            removed = db.session.scalar(
+                select(FileArchive.removed)
+                .where(FileArchive.sha256 == digest))
+        return bool(removed)
+
+
+removed_index = RemovedIndex()
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts its least recently used entries
+
+    Entries also expire ttl seconds after they were added. Lookups of keys
+    that aren't cached return LRUCache.missing, so None can be cached too.
+    """
+    missing = object()
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return LRUCache.missing
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hit_rate}
+
+
+class FileMeta(typing.NamedTuple):
+    """
+    The parts of a File needed to serve it
+    """
+    id: int
+    sha256: str
+    ext: str
+    mime: str
+    size: int
+    secret: str
+    removed: bool
+    expiration: int
+    stored: bool
+    pack_segment: typing.Optional[int] = None
+    pack_offset: typing.Optional[int] = None
+
+    def getpath(self) -> Path:
+        return storage_layout.find(self.sha256)
+
+
+"""
+Per-worker cache of FileMeta by file ID, or None for IDs without a file
+
+Changes made by this process invalidate entries immediately. Bans and
+deletions by other processes clear it once the removed index notices them,
+see RemovedIndex.refresh. Other changes made elsewhere, e.g. by prune, take
+effect after FHOST_FILE_CACHE_TTL seconds at the latest.
+"""
+file_cache = LRUCache(app.config["FHOST_FILE_CACHE_SIZE"],
+                      app.config["FHOST_FILE_CACHE_TTL"])
+
+
+def lookup_file(id: int) -> typing.Optional[FileMeta]:
+    # Forgets files banned or deleted by other processes
+    removed_index.refresh()
+
+    meta = file_cache.get(id)
+
+    if meta is not LRUCache.missing:
+        if meta is None or meta.expiration > time.time() * 1000:
+            return meta
+        # Past its expiration, so it might be pruned any moment now
+
+    f = File.query.get(id)
+
+    if f is None:
+        # IDs below the highest one stay missing, unless the file is
+        # restored from the archive, which clears the cache of all workers.
+        # Caching IDs that don't exist yet would hide new uploads.
+        if id < (db.session.scalar(select(func.max(File.id))) or 0):
+            file_cache.put(id, None)
+        return None
+
+    meta = FileMeta(f.id, f.sha256, f.ext, f.mime, f.size, f.secret,
+                    f.removed, f.expiration, f.exists(), f.pack_segment,
+                    f.pack_offset)
+
+    if meta.expiration is not None and meta.expiration > time.time() * 1000:
+        file_cache.put(id, meta)
+
+    return meta
+
+
+"""
+Per-worker cache of short URL targets by ID, or None for unused IDs
+
+Short URLs never change, so entries don't expire.
+"""
+url_cache = LRUCache(app.config["FHOST_URL_CACHE_SIZE"], math.inf)
+
+
+def lookup_url(id: int) -> typing.Optional[str]:
+    target = url_cache.get(id)
+
+    if target is LRUCache.missing:
+        u = db.session.get(URL, id)
+
+        if u:
+            target = u.url
+        elif id < (db.session.scalar(select(func.max(URL.id))) or 0):
+            target = None
+        else:
+            return None  # Might be used by the next shortened URL
+
+        url_cache.put(id, target)
+
+    return target
+
+
+_cache_stats_logged = time.monotonic()
+
+if app.config["FHOST_CACHE_STATS_INTERVAL"] is not None \
+        and not app.logger.isEnabledFor(logging.INFO):
+    app.logger.setLevel(logging.INFO)
+
+
+def log_cache_stats() -> None:
+    """
+    Logs how well this worker's caches work
+
+    Does so at most every FHOST_CACHE_STATS_INTERVAL seconds, or never if
+    that is None.
+    """
+    global _cache_stats_logged
+
+    interval = app.config["FHOST_CACHE_STATS_INTERVAL"]
+    now = time.monotonic()
+    if interval is None or now - _cache_stats_logged < interval:
+        return
+    _cache_stats_logged = now
+
+    for name, cache in (("File", file_cache), ("URL", url_cache)):
+        stats = cache.stats()
+        app.logger.info(f"{name} cache of worker {os.getpid()}: "
+                        f"{stats['entries']} entries, {stats['hits']} hits, "
+                        f"{stats['misses']} misses, hit rate "
+                        f"{stats['hit_rate']:.1%}")
+
+
+def uploaded_files(r: Request) -> list:
+    """
+    Returns the files uploaded as "file" or "file[]", in order
+
+    r.files groups files by field name, so they are sorted back into the
+    order FhostRequest received them in.
+    """
+    files = r.files.getlist("file") + r.files.getlist("file[]")
+    order = {id(ingest): i for i, ingest
+             in enumerate(r.__dict__.get("ingest_files", []))}
+    return sorted(files, key=lambda f: order.get(id(f.stream), 0))
+
+
+class FilterMatch(typing.NamedTuple):
+    id: int
+    reason: str
+
+
+class RegexFilterSet:
+    """
+    Matches a string against many filter regexes at once
+
+    The expressions are combined into one alternation of named groups, so
+    the string is scanned by a single compiled pattern. Alternatives are
+    tried in order, so the matching filter with the lowest ID wins, just
+    like when checking them one by one. Expressions that can't be combined
+    safely (numbered back references, conflicting group names or flags) are
+    checked separately.
+    """
+    def __init__(self, filters: typing.Iterable[tuple]):
+        self.groups = {}
+        self.separate = []
+        self.combined = None
+
+        combinable = []
+        for fid, regex, reason in sorted(filters, key=lambda x: x[0]):
+            try:
+                rx = re.compile(regex)
+            except (re.error, TypeError):
+                app.logger.warning(f"Ignoring invalid regex in request "
+                                   f"filter {fid}: {regex!r}")
+                continue
+
+            if re.search(r"\\[1-9]|\(\?\(", regex):
+                self.separate.append((rx, FilterMatch(fid, reason)))
+            else:
+                combinable.append((rx, FilterMatch(fid, reason)))
+
+        if combinable:
+            try:
+                self.combined = re.compile("|".join(
+                    f"(?P<_f{e.id}>{rx.pattern})" for rx, e in combinable))
+                self.groups = {f"_f{e.id}": e for rx, e in combinable}
+            except re.error:
+                self.separate = sorted(self.separate + combinable,
+                                       key=lambda x: x[1].id)
+
+    def match(self, s: str) -> typing.Optional[FilterMatch]:
+        found = None
+        if self.combined:
+            m = self.combined.match(s)
+            if m:
+                found = self.groups[m.lastgroup]
+
+        for rx, entry in self.separate:
+            if found and found.id < entry.id:
+                break
+            if rx.match(s):
+                found = entry
+                break
+
+        return found
+
+
+class RequestFilterSet:
+    """
+    Compiled form of all request filters
+
+    Addresses are kept in a hash set, networks in one hash table per prefix
+    length, so finding out whether an address is blocked takes at most one
+    lookup per distinct prefix length instead of one check per filter.
+    User agent and MIME type regexes are combined using RegexFilterSet.
+    """
+    def __init__(self, filters: typing.Iterable[RequestFilter]):
+        self.addrs = {}
+        self.nets = {4: {}, 6: {}}
+        ua = []
+        mime = []
+
+        for flt in sorted(filters, key=lambda f: f.id):
+            entry = FilterMatch(flt.id, flt.reason)
+            match flt:
+                case AddrFilter():
+                    self.addrs.setdefault(flt.addr, entry)
+                case NetFilter():
+                    net = flt.net
+                    key = int(net.network_address) >> \
+                        (net.max_prefixlen - net.prefixlen)
+                    self.nets[net.version].setdefault(net.prefixlen, {}) \
+                        .setdefault(key, entry)
+                case UAFilter():
+                    ua.append((flt.id, flt.regex, entry.reason))
+                case MIMEFilter():
+                    mime.append((flt.id, flt.regex, entry.reason))
+
+        self.ua = RegexFilterSet(ua)
+        self.mime = RegexFilterSet(mime)
+
+    @staticmethod
+    def first(*matches) -> typing.Optional[FilterMatch]:
+        return min(filter(None, matches), key=lambda m: m.id, default=None)
+
+    def match_addr(self, addr: ipaddress._BaseAddress) \
+            -> typing.Optional[FilterMatch]:
+        if type(addr) is ipaddress.IPv6Address:
+            addr = addr.ipv4_mapped or addr
+
+        found = [self.addrs.get(addr)]
+        a = int(addr)
+        for plen, nets in self.nets[addr.version].items():
+            found.append(nets.get(a >> (addr.max_prefixlen - plen)))
+
+        return self.first(*found)
+
+    def match_ua(self, ua: str) -> typing.Optional[FilterMatch]:
+        return self.ua.match(ua)
+
+    def match_mime(self, mime: str) -> typing.Optional[FilterMatch]:
+        return self.mime.match(mime)
+
+    def check_headers(self, r: Request) -> typing.Optional[FilterMatch]:
+        """
+        Checks the filters that only need the request headers
+
+        This does not touch the request body.
+        """
+        return self.first(
+            self.match_addr(ipaddress.ip_address(r.remote_addr)),
+            self.match_ua(r.user_agent.string))
+
+    def check_files(self, r: Request) -> typing.Optional[FilterMatch]:
+        """
+        Checks the MIME types the client specified for uploaded files
+
+        This causes the request body to be parsed.
+        """
+        return self.first(*(self.match_mime(f.mimetype)
+                            for f in uploaded_files(r)))
+
+    def check_request(self, r: Request) -> typing.Optional[FilterMatch]:
+        return self.check_headers(r) or self.check_files(r)
+
+
+_request_filters = (None, None)
+
+
+def request_filters() -> RequestFilterSet:
+    """
+    Returns the compiled request filters, rebuilding them if they changed
+    """
+    global _request_filters
+    gen = Generation.get("request_filter")
+
+    if _request_filters[0] != gen:
+        _request_filters = (gen, RequestFilterSet(RequestFilter.query.all()))
+
+    return _request_filters[1]
+
+
+class UrlEncoder(object):
+    def __init__(self, alphabet, min_length):
+        self.alphabet = alphabet
+        self.min_length = min_length
+
+    def enbase(self, x):
+        n = len(self.alphabet)
+        str = ""
+        while x > 0:
+            str = (self.alphabet[int(x % n)]) + str
+            x = int(x // n)
+        padding = self.alphabet[0] * (self.min_length - len(str))
+        return '%s%s' % (padding, str)
+
+    def debase(self, x):
+        n = len(self.alphabet)
+        result = 0
+        for i, c in enumerate(reversed(x)):
             result += self.alphabet.index(c) * (n ** i)
         return result
 
@@ -509,16 +2174,30 @@ def is_fhost_url(url):
     return url.startswith(fhost_url()) or url.startswith(fhost_url("https"))
 
 
-def shorten(url):
-    if len(url) > app.config["MAX_URL_LENGTH"]:
-        abort(414)
+"""
+Shortens one or more URLs, separated by newlines
+
+Responds with one short URL per line, in the same order.
+"""
+def shorten(urls):
+    from validators import url as url_valid
+
+    urls = [url.strip() for url in urls.splitlines() if url.strip()]
 
-    if not url_valid(url) or is_fhost_url(url) or "\n" in url:
+    if not urls:
         abort(400)
 
-    u = URL.get(url)
+    if len(urls) > app.config["FHOST_MAX_SHORTEN_URLS"]:
+        abort(413)
+
+    for url in urls:
+        if len(url) > app.config["MAX_URL_LENGTH"]:
+            abort(414)
+
+        if not url_valid(url) or is_fhost_url(url):
+            abort(400)
 
-    return u.geturl()
+    return "".join(u.geturl() for u in URL.get_many(urls))
 
 
 """
@@ -531,45 +2210,265 @@ Any value greater that the longest allowed file lifespan will be rounded down
 to that value.
 """
 def store_file(f, requested_expiration: typing.Optional[int], addr, ua,
-               secret: bool):
-    sf, isnew = File.store(f, requested_expiration, addr, ua, secret)
+               secret: bool, expected_digest: typing.Optional[str] = None):
+    return store_files([f], requested_expiration, addr, ua, secret,
+                       expected_digest)
 
+
+"""
+Stores any number of files, responding with one URL per line
+
+X-Expires and X-Token contain comma-separated lists of values in the same
+order. Files that already existed get an empty token.
+"""
+def store_files(files: list, requested_expiration: typing.Optional[int],
+                addr, ua, secret: bool,
+                expected_digest: typing.Optional[str] = None):
+    stored = File.store_many(files, requested_expiration, addr, ua, secret,
+                             expected_digest)
+    return stored_response(stored)
+
+
+def stored_response(stored: list) -> Response:
+    """
+    Responds with the URLs of a list of (File, isnew) tuples
+    """
+    response = make_response("".join(sf.geturl() for sf, isnew in stored))
+    response.headers["X-Expires"] = ",".join(str(sf.expiration)
+                                             for sf, isnew in stored)
+
+    if any(isnew for sf, isnew in stored):
+        response.headers["X-Token"] = ",".join(
+            sf.mgmt_token if isnew else "" for sf, isnew in stored)
+
+    return response
+
+
+def store_hash(digest: str, size: int,
+               requested_expiration: typing.Optional[int], addr, ua):
+    sf = File.store_by_hash(digest, size, requested_expiration, addr, ua)
+
+    if not sf:
+        abort(404)
+
+    # No X-Token: knowing the hash of a file doesn't make it yours
     response = make_response(sf.geturl())
     response.headers["X-Expires"] = sf.expiration
+    return response
 
-    if isnew:
-        response.headers["X-Token"] = sf.mgmt_token
 
-    return response
+_fetch_session = None
+_fetch_session_pid = None
+
+
+def get_fetch_session():
+    """
+    Returns this process' HTTP session for fetching remote URLs
+
+    The session keeps connections to origins alive between requests. It's
+    created on first use, so workers don't share one inherited through
+    fork().
+    """
+    global _fetch_session, _fetch_session_pid
+
+    if _fetch_session is None or _fetch_session_pid != os.getpid():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=app.config["FHOST_FETCH_POOL_SIZE"])
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = "identity"
+        session.max_redirects = app.config["FHOST_FETCH_MAX_REDIRECTS"]
+        session.verify = False
+
+        _fetch_session = session
+        _fetch_session_pid = os.getpid()
+
+    return _fetch_session
+
+
+def fetch_url(url: str,
+              progress: typing.Optional[typing.Callable] = None,
+              cached: typing.Optional[RemoteFile] = None
+              ) -> typing.Optional[FileStorage]:
+    """
+    Downloads a remote file into an IngestFile spool
+
+    The body is hashed while it is received and may be sent with chunked
+    encoding, as the size is enforced while downloading. Aborts with 413 if
+    the file is larger than MAX_CONTENT_LENGTH, with 504 if the origin is
+    too slow and with 502 if it can't be reached. HTTP errors from the
+    origin are raised as requests.exceptions.HTTPError.
+
+    If given, progress is called with the number of bytes received so far
+    and the expected size, if the origin sent one, after each chunk.
+
+    If what the URL pointed to before is passed as cached, the request is
+    made conditional on it having changed. Returns None if it hasn't.
+
+    The caller has to close the returned file's stream. Its headers hold
+    the origin's ETag and Last-Modified validators, if any.
+    """
+    import requests
+    import urllib3.exceptions
+    from urllib3.exceptions import ReadTimeoutError
+
+    max_size = app.config["MAX_CONTENT_LENGTH"]
+    deadline = time.monotonic() + app.config["FHOST_FETCH_MAX_TIME"]
+
+    headers = {}
+    if cached:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    try:
+        r = get_fetch_session().get(url, stream=True, headers=headers,
+                                    timeout=app.config["FHOST_FETCH_TIMEOUT"])
+    except requests.exceptions.Timeout:
+        abort(504)
+    except requests.exceptions.RequestException:
+        abort(502)
+
+    with r:
+        if r.status_code == 304 and headers:
+            return None
+
+        r.raise_for_status()
+
+        length = r.headers.get("content-length")
+        if length and length.isdigit():
+            length = int(length)
+            if length > max_size:
+                abort(413)
+        else:
+            length = None
+
+        if hasattr(r.raw, "read1"):
+            # Takes whatever has arrived instead of waiting for 64 KiB, so
+            # origins trickling data can't get around the deadline
+            chunks = iter(lambda: r.raw.read1(65536, decode_content=True),
+                          b"")
+        else:
+            chunks = r.iter_content(65536)
+
+        ingest = IngestFile(Path(app.config["FHOST_STORAGE_PATH"]))
+        try:
+            for chunk in chunks:
+                if ingest.size + len(chunk) > max_size:
+                    abort(413)
+                if time.monotonic() > deadline:
+                    abort(504)
+                ingest.write(chunk)
+                if progress:
+                    progress(ingest.size, length)
+        except (requests.exceptions.Timeout, ReadTimeoutError):
+            ingest.close()
+            abort(504)
+        except requests.exceptions.ConnectionError as e:
+            ingest.close()
+            # iter_content raises read timeouts while receiving the body
+            # like this
+            abort(504 if e.args and isinstance(e.args[0], ReadTimeoutError)
+                  else 502)
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError):
+            ingest.close()
+            abort(502)
+        except BaseException:
+            ingest.close()
+            raise
+
+    ingest.seek(0)
+    validators = Headers({k: r.headers[k] for k in ("ETag", "Last-Modified")
+                          if k in r.headers})
+    return FileStorage(stream=ingest, filename="", headers=validators,
+                       content_type=r.headers.get("content-type"))
+
+
+def store_remote(url: str, addr, ua, secret: bool,
+                 progress: typing.Optional[typing.Callable] = None) -> tuple:
+    """
+    Stores a remote file, without downloading it again if we can help it
+
+    URLs fetched within the last FHOST_FETCH_CACHE_TTL seconds are taken to
+    still point to the same file. Beyond that, the origin is asked whether
+    it changed. Either way, if the file is still here, it is stored again
+    like File.store_by_hash would. Secret uploads are always downloaded.
+
+    Returns a (File, isnew) tuple like File.store.
+    """
+    cached = None if secret else RemoteFile.get(url)
+
+    if cached and time.time() - cached.fetched / 1000 < \
+            app.config["FHOST_FETCH_CACHE_TTL"]:
+        sf = File.store_by_hash(cached.sha256, cached.size, None, addr, ua)
+        if sf:
+            return sf, False
+        cached = None
+
+    f = fetch_url(url, progress, cached)
+
+    if f is None:
+        sf = File.store_by_hash(cached.sha256, cached.size, None, addr, ua)
+        if sf:
+            cached.fetched = time.time() * 1000
+            db.session.commit()
+            return sf, False
+        f = fetch_url(url, progress)
+
+    try:
+        sf, isnew = File.store(f, None, addr, ua, secret)
+    finally:
+        f.stream.close()
+
+    if not secret:
+        RemoteFile.record(url, sf, f.headers)
+
+    return sf, isnew
 
 
 def store_url(url, addr, ua, secret: bool):
     if is_fhost_url(url):
         abort(400)
 
-    h = {"Accept-Encoding": "identity"}
-    r = requests.get(url, stream=True, verify=False, headers=h)
+    import requests
 
     try:
-        r.raise_for_status()
+        return stored_response([store_remote(url, addr, ua, secret)])
     except requests.exceptions.HTTPError as e:
         return str(e) + "\n"
 
-    if "content-length" in r.headers:
-        length = int(r.headers["content-length"])
 
-        if length <= app.config["MAX_CONTENT_LENGTH"]:
-            def urlfile(**kwargs):
-                return type('', (), kwargs)()
+def queue_fetch(url, addr, ua, secret: bool):
+    """
+    Queues a URL upload for the fetch worker
 
-            f = urlfile(read=r.raw.read,
-                        content_type=r.headers["content-type"], filename="")
+    Responds with 202 and the URL the job's status can be polled at. Each
+    address may only have FHOST_FETCH_MAX_JOBS_PER_ADDR jobs pending, and no
+    more than FHOST_FETCH_MAX_JOBS jobs are accepted altogether.
+    """
+    if is_fhost_url(url):
+        abort(400)
 
-            return store_file(f, None, addr, ua, secret)
-        else:
-            abort(413)
-    else:
-        abort(411)
+    pending = FetchJob.pending()
+    if pending.filter(FetchJob.addr == addr).count() >= \
+            app.config["FHOST_FETCH_MAX_JOBS_PER_ADDR"]:
+        abort(429)
+    if pending.count() >= app.config["FHOST_FETCH_MAX_JOBS"]:
+        abort(503)
+
+    job = FetchJob(url, secret, addr, ua)
+    db.session.add(job)
+    db.session.commit()
+
+    response = make_response(job.geturl() + "\n", 202)
+    response.headers["Location"] = job.geturl()
+    response.headers["X-Job-Id"] = job.token
+    return response
 
 
 def manage_file(f):
@@ -593,6 +2492,218 @@ def manage_file(f):
     abort(400)
 
 
+def set_cache_headers(response: Response, f: FileMeta) -> None:
+    """
+    Lets clients and proxies cache a file until it expires
+
+    Stored files never change, so their SHA-256 is a strong ETag. Secret
+    files may only be cached by the client itself.
+    """
+    response.set_etag(f.sha256)
+    cc = response.cache_control
+    cc.no_cache = None
+
+    if f.secret:
+        cc.private = True
+    else:
+        cc.public = True
+
+    max_age = 0
+    if f.expiration is not None:
+        max_age = int(f.expiration / 1000 - time.time())
+
+    if max_age > 0:
+        cc.max_age = max_age
+        cc.immutable = True
+    else:
+        # Expired but not pruned yet, or a legacy row without expiration
+        cc.no_cache = True
+
+
+"""
+Requests for more ranges than this get the whole file instead, which is
+cheaper than answering a crafted request for thousands of tiny ranges.
+"""
+MAX_RANGES = 32
+
+"""
+How much of a mapped file is passed to the server at once
+"""
+SERVE_CHUNK_SIZE = 256 * 1024
+
+
+def requested_ranges(f: FileMeta,
+                     size: int) -> typing.Optional[list[tuple[int, int]]]:
+    """
+    Returns the byte ranges to serve for the current request
+
+    None means the whole file, e.g. for requests without a usable Range
+    header. Ranges are half-open, sorted and coalesced. An empty list
+    means none of the requested ranges can be satisfied.
+    """
+    rng = request.range
+
+    if rng is None or rng.units != "bytes":
+        return None
+
+    if "If-Range" in request.headers and \
+       request.if_range.etag != f.sha256:
+        return None
+
+    ranges = []
+    for start, end in rng.ranges:
+        if start < 0:
+            start = max(size + start, 0)
+            end = size
+        elif end is None or end > size:
+            end = size
+
+        if start < end:
+            ranges.append((start, end))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES or merged == [(0, size)]:
+        return None
+
+    return merged
+
+
+def iter_parts(buf: mmap.mmap | bytes, parts: list) -> typing.Iterator:
+    """
+    Yields the given byte strings and (start, end) ranges of buf in order
+
+    A memory map is closed once the server is done with the response.
+    """
+    try:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            start, end = part
+            for off in range(start, end, SERVE_CHUNK_SIZE):
+                yield buf[off:min(off + SERVE_CHUNK_SIZE, end)]
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def iter_remote(digest: str, parts: list) -> typing.Iterator:
+    """
+    Like iter_parts, but reads ranges from the storage backend
+    """
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            yield from storage_backend.read_range(digest, *part)
+
+
+def serve_file(f: FileMeta) -> Response:
+    """
+    Serves a stored file, including single and multiple byte ranges
+
+    Used when neither nginx nor the WSGI server can serve the file on their
+    own. The whole file and ranges reaching its end are handed to the
+    server's wsgi.file_wrapper, which uWSGI and gunicorn implement with
+    sendfile(2). Everything else is served from a read-only memory map.
+
+    Files in a pack segment are always served from here. They are small, so
+    they are read with a single pread(2). Files in an object store are
+    streamed from it with ranged requests.
+    """
+    fd = None
+    if f.pack_segment is not None:
+        fd = os.open(pack_store.segpath(f.pack_segment), os.O_RDONLY)
+        size = f.size
+    elif not storage_backend.local:
+        size = f.size
+    else:
+        fd = os.open(f.getpath(), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+        except BaseException:
+            os.close(fd)
+            raise
+
+    ranges = requested_ranges(f, size)
+    headers = {"Accept-Ranges": "bytes"}
+
+    if ranges == []:
+        if fd is not None:
+            os.close(fd)
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if ranges is None:
+        status = 200
+        length = size
+    elif len(ranges) == 1:
+        status = 206
+        start, end = ranges[0]
+        length = end - start
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    else:
+        status = 206
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            parts.append(f"\r\n--{boundary}\r\n"
+                         f"Content-Type: {f.mime}\r\n"
+                         f"Content-Range: bytes {start}-{end - 1}/{size}"
+                         "\r\n\r\n".encode())
+            parts.append((start, end))
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+
+        length = sum(len(p) if isinstance(p, bytes) else p[1] - p[0]
+                     for p in parts)
+
+    if ranges is None:
+        parts = [(0, size)]
+    elif len(ranges) == 1:
+        parts = ranges
+
+    to_end = ranges is None or (len(ranges) == 1 and ranges[0][1] == size)
+
+    if request.method == "HEAD" or size == 0:
+        if fd is not None:
+            os.close(fd)
+        body = ()
+    elif fd is None:
+        body = iter_remote(f.sha256, parts)
+    elif "wsgi.file_wrapper" in request.environ \
+            and f.pack_segment is None and to_end:
+        fobj = os.fdopen(fd, "rb")
+        if ranges:
+            fobj.seek(ranges[0][0])
+        body = wrap_file(request.environ, fobj, SERVE_CHUNK_SIZE)
+    else:
+        try:
+            if f.pack_segment is not None:
+                buf = os.pread(fd, size, f.pack_offset)
+            else:
+                buf = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        body = iter_parts(buf, parts)
+
+    response = Response(body, status, headers, direct_passthrough=True)
+    if len(ranges or ()) > 1:
+        response.content_type = f"multipart/byteranges; boundary={boundary}"
+    else:
+        response.content_type = f.mime
+    response.content_length = length
+    return response
+
+
 @app.route("/<path:path>", methods=["GET", "POST"])
 @app.route("/s/<secret>/<path:path>", methods=["GET", "POST"])
 def get(path, secret=None):
@@ -604,9 +2715,10 @@ def get(path, secret=None):
         abort(404)
 
     id = su.debase(name)
+    log_cache_stats()
 
     if sufs:
-        f = File.query.get(id)
+        f = lookup_file(id)
 
         if f and f.ext == sufs:
             if f.secret != secret:
@@ -615,26 +2727,60 @@ def get(path, secret=None):
             if f.removed:
                 abort(451)
 
-            fpath = f.getpath()
-
-            if not fpath.is_file():
+            if not f.stored:
                 abort(404)
 
             if request.method == "POST":
-                return manage_file(f)
-
-            if app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
+                return manage_file(File.query.get(id))
+
+            if request.if_none_match.contains_weak(f.sha256):
+                response = Response(status=304)
+            elif f.pack_segment is not None:
+                # Neither nginx nor X-Sendfile can serve part of a segment
+                try:
+                    response = serve_file(f)
+                except FileNotFoundError:
+                    abort(404)  # compacted since it was looked up
+            elif not storage_backend.local:
+                if app.config["FHOST_S3_REDIRECT"]:
+                    expiry = app.config["FHOST_S3_URL_EXPIRY"]
+                    response = redirect(storage_backend.presign(
+                        f.sha256, f.mime, expiry))
+                    # Don't let anyone hold on to the URL past its expiry
+                    response.cache_control.private = True
+                    response.cache_control.max_age = expiry // 2
+                    response.headers["X-Expires"] = f.expiration
+                    return response
+
+                try:
+                    response = serve_file(f)
+                except FileNotFoundError:
+                    abort(404)
+            elif app.config["FHOST_USE_X_ACCEL_REDIRECT"]:
                 response = make_response()
                 response.headers["Content-Type"] = f.mime
                 response.headers["Content-Length"] = f.size
-                response.headers["X-Accel-Redirect"] = "/" + str(fpath)
-            else:
+                response.headers["X-Accel-Redirect"] = "/" + str(f.getpath())
+            elif app.config["USE_X_SENDFILE"]:
                 response = send_from_directory(
-                    app.config["FHOST_STORAGE_PATH"], f.sha256,
-                    mimetype=f.mime)
+                    app.config["FHOST_STORAGE_PATH"],
+                    f.getpath().relative_to(storage_layout.root),
+                    mimetype=f.mime, etag=f.sha256)
+            else:
+                try:
+                    response = serve_file(f)
+                except FileNotFoundError:
+                    abort(404)  # removed since it was looked up
 
+            set_cache_headers(response, f)
             response.headers["X-Expires"] = f.expiration
             return response
+
+        if f is None:
+            # Files that expired long ago are only in the archive
+            a = db.session.get(FileArchive, id)
+            if a and a.removed:
+                abort(451)
     else:
         if request.method == "POST":
             abort(405)
@@ -642,50 +2788,108 @@ def get(path, secret=None):
         if "/" in path:
             abort(404)
 
-        u = URL.query.get(id)
+        target = lookup_url(id)
 
-        if u:
-            return redirect(u.url)
+        if target:
+            max_age = app.config["FHOST_REDIRECT_MAX_AGE"]
+
+            if not max_age:
+                return redirect(target)
+
+            response = redirect(target, 301)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
 
     abort(404)
 
 
+def client_addr() -> ipaddress._BaseAddress:
+    addr = ipaddress.ip_address(request.remote_addr)
+    if type(addr) is ipaddress.IPv6Address:
+        addr = addr.ipv4_mapped or addr
+    return addr
+
+
+def check_header_filters() -> RequestFilterSet:
+    """
+    Rejects the current request if a filter matches its headers
+
+    Returns the request filters for checking the body later on.
+    """
+    filters = request_filters()
+    flt = filters.check_headers(request)
+    if flt:
+        abort(403, flt.reason)
+
+    return filters
+
+
 @app.route("/", methods=["GET", "POST"])
 def fhost():
     if request.method == "POST":
-        for flt in RequestFilter.query.all():
-            if flt.check_request(request):
-                abort(403, flt.reason)
+        # Reject whatever we can before the request body gets read
+        filters = check_header_filters()
+
+        if (request.content_length or 0) > app.config["MAX_CONTENT_LENGTH"]:
+            abort(413)
+
+        flt = filters.check_files(request)
+        if flt:
+            abort(403, flt.reason)
 
         sf = None
         secret = "secret" in request.form
-        addr = ipaddress.ip_address(request.remote_addr)
-        if type(addr) is ipaddress.IPv6Address:
-            addr = addr.ipv4_mapped or addr
+        addr = client_addr()
+
+        digest = None
+        if "sha256" in request.form:
+            digest = request.form["sha256"].lower()
+            if not re.fullmatch("[0-9a-f]{64}", digest):
+                abort(400)
+
+        files = uploaded_files(request)
 
-        if "file" in request.files:
+        if files:
             try:
-                # Store the file with the requested expiration date
-                return store_file(
-                    request.files["file"],
+                # Store the files with the requested expiration date
+                return store_files(
+                    files,
                     int(request.form["expires"]),
                     addr,
                     request.user_agent.string,
-                    secret
+                    secret,
+                    digest
                 )
             except ValueError:
                 # The requested expiration date wasn't properly formed
                 abort(400)
             except KeyError:
                 # No expiration date was requested, store with the max lifespan
-                return store_file(
-                    request.files["file"],
+                return store_files(
+                    files,
                     None,
                     addr,
                     request.user_agent.string,
-                    secret
+                    secret,
+                    digest
                 )
+        elif digest:
+            # Preflight: only the checksum and size of the file were sent
+            try:
+                size = int(request.form["size"])
+                requested_expiration = None
+                if "expires" in request.form:
+                    requested_expiration = int(request.form["expires"])
+            except (KeyError, ValueError):
+                abort(400)
+
+            return store_hash(digest, size, requested_expiration, addr,
+                              request.user_agent.string)
         elif "url" in request.form:
+            if "async" in request.form and app.config["FHOST_FETCH_ASYNC"]:
+                return queue_fetch(request.form["url"], addr,
+                                   request.user_agent.string, secret)
             return store_url(
                 request.form["url"],
                 addr,
@@ -700,6 +2904,199 @@ def fhost():
         return render_template("index.html")
 
 
+@app.route("/upload", methods=["POST"])
+def upload_create():
+    """
+    Starts a resumable upload
+
+    Expects the total size of the file in bytes, and optionally its name,
+    MIME type, expiration and whether it should be secret. Responds with the
+    URL chunks are to be sent to.
+    """
+    filters = check_header_filters()
+
+    try:
+        size = int(request.form["size"])
+        requested_expiration = None
+        if "expires" in request.form:
+            requested_expiration = int(request.form["expires"])
+    except (KeyError, ValueError):
+        abort(400)
+
+    if size < 0:
+        abort(400)
+    if size > app.config["MAX_CONTENT_LENGTH"]:
+        abort(413)
+
+    mime = request.form.get("type")
+    if mime:
+        flt = filters.match_mime(mime)
+        if flt:
+            abort(403, flt.reason)
+
+    us = UploadSession(size, request.form.get("filename", ""), mime,
+                       requested_expiration, "secret" in request.form,
+                       client_addr(), request.user_agent.string)
+
+    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    storage.mkdir(parents=True, exist_ok=True)
+    us.getpath().touch(mode=0o666, exist_ok=False)
+
+    db.session.add(us)
+    db.session.commit()
+
+    response = make_response(us.geturl() + "\n", 201)
+    response.headers["Location"] = us.geturl()
+    response.headers["Upload-Offset"] = 0
+    response.headers["Upload-Length"] = us.size
+    return response
+
+
+@app.route("/upload/<token>", methods=["GET", "PUT", "PATCH", "POST"])
+def upload_chunk(token):
+    """
+    Receives, reports on and finishes resumable uploads
+
+    PUT or PATCH store the request body at the byte offset given in the
+    Upload-Offset header. If an Upload-Checksum header of the form
+    "sha256 <hex digest>" is present, the chunk is verified against it.
+    GET and HEAD report the offset up to which the file has been received
+    without gaps, and POST finishes the upload once it is complete.
+    """
+    check_header_filters()
+
+    us = UploadSession.query.filter_by(token=token).first()
+    if not us:
+        abort(404)
+
+    if request.method in ("GET", "HEAD"):
+        response = make_response("")
+    elif request.method == "POST":
+        return upload_finish(us)
+    else:
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            abort(400)
+
+        if offset < 0 or offset > us.size:
+            abort(400)
+
+        expected = request.headers.get("Upload-Checksum", "").split()
+        if expected and (len(expected) != 2 or expected[0] != "sha256"):
+            abort(400)
+
+        # Extend the running hash if this is the chunk it is waiting for
+        state = _upload_hashers.get(token)
+        if state and offset < state.end:
+            # Overwrites data that has been hashed already
+            _upload_hashers.pop(token, None)
+            state = None
+
+        hasher = None
+        chunks = ()
+        if offset == 0:
+            hasher = sha256()
+        elif state and state.end == offset:
+            hasher = state.hasher.copy()
+            chunks = state.chunks
+
+        chash = sha256()
+        length = 0
+        fd = os.open(us.getpath(), os.O_WRONLY)
+        try:
+            for chunk in iter(lambda: request.stream.read(65536), b""):
+                if offset + length + len(chunk) > us.size:
+                    abort(413)
+                os.pwrite(fd, chunk, offset + length)
+                length += len(chunk)
+                chash.update(chunk)
+                if hasher:
+                    hasher.update(chunk)
+        finally:
+            os.close(fd)
+
+        if expected and chash.hexdigest() != expected[1].lower():
+            abort(400, "Checksum mismatch.")
+
+        if hasher:
+            now = time.monotonic()
+            ttl = app.config["FHOST_UPLOAD_SESSION_TTL"] / 1000
+            for t, st in list(_upload_hashers.items()):
+                if now - st.touched > ttl:
+                    _upload_hashers.pop(t, None)
+
+            chunks += ((offset, length, chash.hexdigest()),)
+            _upload_hashers[token] = UploadHash(offset + length, hasher,
+                                                chunks, now)
+
+        db.session.merge(UploadChunk(session_id=us.id, offset=offset,
+                                     length=length, sha256=chash.hexdigest()))
+        us.updated = time.time() * 1000
+        db.session.commit()
+        db.session.refresh(us)
+
+        response = make_response("", 204)
+
+    response.headers["Upload-Offset"] = us.offset
+    response.headers["Upload-Length"] = us.size
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def upload_finish(us: UploadSession):
+    if us.offset != us.size:
+        abort(409, "Upload incomplete.")
+
+    # Only trust the running hash if nothing else was written to the spool
+    hasher = None
+    state = _upload_hashers.get(us.token)
+    if state and state.end == us.size and state.chunks == tuple(
+            (c.offset, c.length, c.sha256) for c in us.chunks):
+        hasher = state.hasher
+
+    ingest = IngestFile.resume(us.getpath(), us.size, hasher)
+    fs = FileStorage(stream=ingest, filename=us.filename,
+                     content_type=us.mime)
+
+    try:
+        return store_file(fs, us.requested_expiration, client_addr(),
+                          request.user_agent.string, us.secret)
+    finally:
+        ingest.close()
+        us.delete()
+        db.session.commit()
+
+
+@app.route("/fetch/<token>")
+def fetch_status(token):
+    """
+    Reports on a URL upload queued with the async option
+
+    The state of the job is sent in the Fetch-State header, along with the
+    number of bytes received so far and, if known, the size of the file.
+    Once done, responds like a synchronous upload would have.
+    """
+    job = FetchJob.query.filter_by(token=token).first()
+    if not job:
+        abort(404)
+
+    match job.state:
+        case "done":
+            response = stored_response([(job.file, job.new)])
+        case "failed":
+            response = make_response(job.error + "\n", job.code)
+        case _:
+            response = make_response(f"{job.state}\n", 202)
+
+    response.headers["Fetch-State"] = job.state
+    response.headers["Fetch-Received"] = job.received
+    if job.size is not None:
+        response.headers["Fetch-Length"] = job.size
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
 @app.route("/robots.txt")
 def robots():
     return """User-agent: *
@@ -711,11 +3108,16 @@ Disallow: /
 @app.errorhandler(401)
 @app.errorhandler(403)
 @app.errorhandler(404)
+@app.errorhandler(409)
 @app.errorhandler(411)
 @app.errorhandler(413)
 @app.errorhandler(414)
 @app.errorhandler(415)
+@app.errorhandler(429)
 @app.errorhandler(451)
+@app.errorhandler(502)
+@app.errorhandler(503)
+@app.errorhandler(504)
 def ehandler(e):
     try:
         return render_template(f"{e.code}.html", id=id, request=request,
@@ -724,8 +3126,225 @@ def ehandler(e):
         return "Segmentation fault\n", e.code
 
 
+"""
+Number of files maintenance commands process per transaction
+
+Every transaction that writes holds SQLite's write lock until it commits,
+blocking uploads in the meantime.
+"""
+MAINTENANCE_BATCH_SIZE = 500
+
+
+"""
+Columns of expired files needed to remove them
+"""
+EXPIRED_COLUMNS = (File.id, File.sha256, File.ext, File.size,
+                   File.pack_segment, File.expiration)
+
+
+def remove_expired(rows: list, pool, stats: Counter, dry_run=False,
+                   verbose=False) -> None:
+    """
+    Deletes expired files from storage and marks them as removed
+
+    The files are deleted by the threads of pool, then marked with a single
+    UPDATE that is committed right away. Files that can't be deleted are
+    left as they are. What happened is counted in stats.
+    """
+    def remove(row):
+        try:
+            # Packed files are reclaimed by compacting their segment
+            if row.pack_segment is None and not dry_run:
+                storage_backend.delete(row.sha256)
+            return row, None
+        except Exception as e:
+            return row, e
+
+    done = []
+    for row, e in pool.map(remove, rows):
+        name = su.enbase(row.id) + row.ext
+        if isinstance(e, FileNotFoundError):
+            stats["missing"] += 1  # If it was already gone, we're good
+        elif e:
+            stats["failed"] += 1
+            print(f"Failed to remove {name} [{row.sha256}]: {e}")
+            continue
+        else:
+            stats["removed"] += 1
+            stats["bytes"] += row.size or 0
+            if verbose:
+                print(f"Removed expired file {name} [{row.sha256}]")
+        done.append(row.id)
+
+    if done and not dry_run:
+        db.session.execute(
+            update(File).where(File.id.in_(done))
+            .values(expiration=None, expired_at=time.time() * 1000,
+                    pack_segment=None, pack_offset=None)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+
+def prune_sweep(pool, stats: Counter, batch_size: int,
+                max_seconds: typing.Optional[float] = None, dry_run=False,
+                verbose=False) -> bool:
+    """
+    Removes all files that have expired by now, in batches
+
+    Returns whether it got through all of them before max_seconds.
+    """
+    started = time.monotonic()
+
+    # All files who've passed their expiration times
+    expired_files = select(*EXPIRED_COLUMNS).where(
+        File.expiration.is_not(None),
+        File.expiration < time.time() * 1000
+    )
+    last = None
+
+    while max_seconds is None or time.monotonic() - started < max_seconds:
+        # Page along the expiration index, so rows already marked as
+        # removed, or skipped, don't have to be looked at again
+        q = expired_files
+        if last:
+            q = q.where(tuple_(File.expiration, File.id) > last)
+        batch = db.session.execute(
+            q.order_by(File.expiration, File.id).limit(batch_size)).all()
+        if not batch:
+            return True
+        last = (batch[-1].expiration, batch[-1].id)
+
+        remove_expired(batch, pool, stats, dry_run, verbose)
+
+    return False
+
+
+def prune_cleanup() -> None:
+    """
+    Removes leftovers of uploads and fetches
+    """
+    # Clean up abandoned resumable uploads
+    stale = time.time() * 1000 - app.config["FHOST_UPLOAD_SESSION_TTL"]
+    sessions = UploadSession.query.filter(UploadSession.updated < stale)
+    for us in sessions:
+        us.delete()
+    db.session.commit()
+
+    # Remove spools left behind by workers that crashed or were killed, and
+    # those of resumable uploads that are gone
+    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    stale = time.time() - app.config["FHOST_SPOOL_TTL"] / 1000
+    active = {".upload-" + token for token in
+              db.session.scalars(select(UploadSession.token))}
+    for path in (*storage.glob(".ingest-*"), *storage.glob(".upload-*")):
+        try:
+            if path.name not in active and path.stat().st_mtime < stale:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+    # Forget where files that are gone now were fetched from
+    stored = select(File.sha256).where(File.expiration != None)
+    db.session.execute(RemoteFile.__table__.delete()
+                       .where(RemoteFile.sha256.not_in(stored)))
+
+    # Forget about finished and abandoned fetch jobs
+    stale = time.time() * 1000 - app.config["FHOST_FETCH_JOB_TTL"]
+    db.session.execute(FetchJob.__table__.delete()
+                       .where(FetchJob.updated < stale))
+    db.session.commit()
+
+
+def prune_daemon(pool, batch_size: int, interval: float,
+                 sweep_interval: float, verbose=False) -> None:
+    """
+    Removes files within seconds of their expiration, until killed
+
+    Upcoming expirations are kept in a heap, which is loaded along the
+    expiration index FHOST_PRUNE_HORIZON seconds ahead at a time. Storing
+    or changing a file that expires within that window bumps the
+    "expiration" generation, upon which the heap is loaded again. Whether
+    files are still due is checked right before removing them, so extended
+    expirations are respected either way.
+
+    Every sweep_interval seconds, a full sweep retries files that couldn't
+    be removed, and leftovers are cleaned up.
+    """
+    horizon = app.config["FHOST_PRUNE_HORIZON"] * 1000
+    heap = []
+    gen = None
+    loaded_until = None
+    next_sweep = 0
+
+    while True:
+        if time.monotonic() >= next_sweep:
+            stats = Counter()
+            prune_sweep(pool, stats, batch_size, verbose=verbose)
+            prune_cleanup()
+            compact_packs()
+            if stats["failed"]:
+                print(f"{stats['failed']} file(s) could not be removed")
+            next_sweep = time.monotonic() + sweep_interval
+
+        now = time.time() * 1000
+
+        g = Generation.get("expiration")
+        if g != gen:
+            gen, heap, loaded_until = g, [], None
+
+        if loaded_until is None or loaded_until - now < horizon / 2:
+            until = now + horizon
+            q = select(File.expiration, File.id).where(
+                File.expiration.is_not(None), File.expiration < until)
+            if loaded_until is not None:
+                q = q.where(File.expiration >= loaded_until)
+            for row in db.session.execute(q):
+                heapq.heappush(heap, tuple(row))
+            loaded_until = until
+
+        due = []
+        while heap and heap[0][0] < now and len(due) < batch_size:
+            due.append(heapq.heappop(heap)[1])
+
+        if due:
+            rows = db.session.execute(select(*EXPIRED_COLUMNS).where(
+                File.id.in_(due), File.expiration.is_not(None),
+                File.expiration < now)).all()
+            stats = Counter()
+            remove_expired(rows, pool, stats, verbose=verbose)
+            if stats["removed"]:
+                print(f"Removed {stats['removed']} expired file(s)")
+            continue
+
+        # Don't leave a transaction open while waiting
+        db.session.rollback()
+
+        wait = interval
+        if heap:
+            wait = min(wait, max(0, (heap[0][0] - now) / 1000))
+        time.sleep(wait)
+
+
 @app.cli.command("prune")
-def prune():
+@click.option("--batch-size", default=MAINTENANCE_BATCH_SIZE,
+              show_default=True,
+              help="Number of files removed per transaction.")
+@click.option("--threads", default=8, show_default=True,
+              help="Number of files deleted from storage at once.")
+@click.option("--max-seconds", default=None, type=float,
+              help="Stop starting new batches after this many seconds.")
+@click.option("--dry-run", is_flag=True,
+              help="Only report what would be removed.")
+@click.option("--verbose", "-v", is_flag=True,
+              help="List every file removed.")
+@click.option("--daemon", is_flag=True,
+              help="Keep running, removing files as soon as they expire.")
+@click.option("--interval", default=1.0, show_default=True,
+              help="With --daemon, the longest time to sleep in seconds.")
+@click.option("--sweep-interval", default=60 * 60, show_default=True,
+              help="With --daemon, seconds between full sweeps.")
+def prune(batch_size, threads, max_seconds, dry_run, verbose, daemon,
+          interval, sweep_interval):
     """
     Clean up expired files
 
@@ -733,51 +3352,193 @@ def prune():
     This doesn't remove them from the database, only from the filesystem.
     It is recommended that server owners run this command regularly, or set it
     up on a timer.
-    """
-    current_time = time.time() * 1000
 
-    # The path to where uploaded files are stored
-    storage = Path(app.config["FHOST_STORAGE_PATH"])
+    Expired files are worked through in batches. The files of each batch are
+    deleted by a pool of threads, then marked as removed with a single
+    UPDATE that is committed right away. Files that can't be deleted are
+    left for the next run. Interrupted runs, or ones cut short by
+    --max-seconds, are continued by simply running prune again.
 
-    # A list of all files who've passed their expiration times
-    expired_files = File.query\
-        .where(
-            and_(
-                File.expiration.is_not(None),
-                File.expiration < current_time
-            )
-        )
+    With --daemon, prune keeps running instead and removes files within
+    seconds of their expiration, see prune_daemon.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from jinja2.filters import do_filesizeformat
+
+    if daemon:
+        # The daemon removes files for real and never stops
+        for option, value in (("--dry-run", dry_run),
+                              ("--max-seconds", max_seconds is not None)):
+            if value:
+                raise click.UsageError(f"{option} can't be used with "
+                                       "--daemon")
+
+    stats = Counter()
+
+    with ThreadPoolExecutor(threads) as pool:
+        if daemon:
+            prune_daemon(pool, batch_size, interval, sweep_interval, verbose)
+        finished = prune_sweep(pool, stats, batch_size, max_seconds, dry_run,
+                               verbose)
+
+    size = do_filesizeformat(stats["bytes"], True)
+    if dry_run:
+        print(f"\nDry run!  {stats['removed']} file(s) totaling {size} would "
+              "be removed")
+    else:
+        print(f"\nDone!  {stats['removed']} file(s) removed, {size} "
+              "reclaimed")
+    if stats["missing"]:
+        print(f"{stats['missing']} file(s) were already gone")
+    if stats["failed"]:
+        print(f"{stats['failed']} file(s) could not be removed. Make sure "
+              "the server is configured correctly, permissions are okay, "
+              "and everything is ship shape, then try again.")
+    if not finished:
+        print("Stopped after --max-seconds, run prune again to continue")
+
+    if dry_run:
+        return
+
+    prune_cleanup()
+
+    if finished:
+        compact_packs()
+
+    if stats["failed"]:
+        sys.exit(1)
 
-    files_removed = 0
 
-    # For every expired file...
-    for file in expired_files:
-        # Log the file we're about to remove
-        file_name = file.getname()
-        file_hash = file.sha256
-        file_path = storage / file_hash
-        print(f"Removing expired file {file_name} [{file_hash}]")
+def compact_packs():
+    """
+    Reclaims space in pack segments taken up by files no longer stored
 
-        # Remove it from the file system
-        try:
-            os.remove(file_path)
-            files_removed += 1
-        except FileNotFoundError:
-            pass  # If the file was already gone, we're good
-        except OSError as e:
-            print(e)
-            print(
-                "\n------------------------------------"
-                "Encountered an error while trying to remove file {file_path}."
-                "Make sure the server is configured correctly, permissions "
-                "are okay, and everything is ship shape, then try again.")
-            return
+    Live files in segments that are less than FHOST_PACK_COMPACT_RATIO full
+    are appended to the active segment. The old segment is deleted by the
+    next run once nothing refers to it, so workers that still have its
+    files cached don't lose them in the middle of a request.
+    """
+    segments = pack_store.segments()[:-1]  # Leave the active one alone
+    if not segments:
+        return
+
+    live = dict(db.session.execute(
+        select(File.pack_segment, func.sum(File.size))
+        .where(File.pack_segment.in_(segments))
+        .group_by(File.pack_segment)).all())
+
+    reclaimed = 0
+    for segment in segments:
+        path = pack_store.segpath(segment)
+        size = path.stat().st_size
+        used = live.get(segment, 0)
+
+        if not used:
+            path.unlink()
+            reclaimed += size
+        elif used < size * app.config["FHOST_PACK_COMPACT_RATIO"]:
+            print(f"Compacting pack segment {segment}")
+            for f in File.query.filter_by(pack_segment=segment):
+                data = pack_store.read(segment, f.pack_offset, f.size)
+                f.pack_segment, f.pack_offset = pack_store.append(data)
+            db.session.commit()
 
-        # Finally, mark that the file was removed
-        file.expiration = None
-    db.session.commit()
+    if reclaimed:
+        print(f"Reclaimed {reclaimed} bytes from pack segments")
+
+
+@app.cli.command("db-compact")
+@click.option("--older-than", default=None, type=float,
+              help="Archive files expired for this many days. Defaults to "
+                   "FHOST_ARCHIVE_AFTER.")
+@click.option("--batch-size", default=MAINTENANCE_BATCH_SIZE,
+              show_default=True,
+              help="Number of files archived per transaction.")
+@click.option("--full-vacuum", is_flag=True,
+              help="Switch SQLite to incremental vacuuming. This runs a "
+                   "full VACUUM once, which locks the database until done.")
+def db_compact(older_than, batch_size, full_vacuum):
+    """
+    Move long expired files to the archive and reclaim database space
 
-    print(f"\nDone!  {files_removed} file(s) removed")
+    Files that expired more than FHOST_ARCHIVE_AFTER ago are moved from the
+    file table to the much narrower file_archive table, which keeps just
+    enough to refuse banned files and to restore files that are uploaded
+    again, under their old ID. The database is then vacuumed incrementally
+    and its statistics updated.
+
+    Safe to run while the service is up. Files are archived in batches,
+    each committed on its own.
+    """
+    if older_than is None:
+        older_than = app.config["FHOST_ARCHIVE_AFTER"]
+    else:
+        older_than *= 24 * 60 * 60 * 1000
+
+    cutoff = time.time() * 1000 - older_than
+
+    # The file with the highest ID is kept, so SQLite doesn't hand out the
+    # IDs of archived files again
+    max_id = db.session.scalar(select(func.max(File.id))) or 0
+    fetched = select(FetchJob.file_id).where(FetchJob.file_id.is_not(None))
+    dead = select(File.id).where(
+        File.expiration.is_(None), File.expired_at < cutoff,
+        File.id < max_id, File.id.not_in(fetched)).limit(batch_size)
+
+    archived = 0
+    while ids := db.session.scalars(dead).all():
+        db.session.execute(FileArchive.__table__.insert().from_select(
+            ["id", "sha256", "removed"],
+            select(File.id, File.sha256, func.coalesce(File.removed, False))
+            .where(File.id.in_(ids))))
+        db.session.execute(NSFWJob.__table__.delete()
+                           .where(NSFWJob.file_id.in_(ids)))
+        db.session.execute(File.__table__.delete().where(File.id.in_(ids)))
+        db.session.commit()
+        archived += len(ids)
+
+    print(f"Archived {archived} file(s)")
+
+    # VACUUM can't run inside a transaction
+    with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        match db.engine.dialect.name:
+            case "sqlite":
+                def pragma(name):
+                    return conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+                pages = pragma("page_count")
+
+                if full_vacuum:
+                    conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                    conn.exec_driver_sql("VACUUM")
+                elif pragma("auto_vacuum") == 2:
+                    # A few pages at a time, so writers aren't held up.
+                    # sqlite3 only runs this for a single page unless it
+                    # is run as a script.
+                    free = pragma("freelist_count")
+                    while free:
+                        conn.connection.executescript(
+                            "PRAGMA incremental_vacuum(1024)")
+                        left = pragma("freelist_count")
+                        if left >= free:
+                            break
+                        free = left
+                elif pragma("freelist_count"):
+                    print("Incremental vacuuming is not enabled. Run "
+                          "db-compact with --full-vacuum once to reclaim "
+                          "the space of archived files.")
+
+                reclaimed = (pages - pragma("page_count")) \
+                    * pragma("page_size")
+                if reclaimed > 0:
+                    print(f"Reclaimed {reclaimed} bytes from the database")
+
+                conn.exec_driver_sql("PRAGMA analysis_limit = 1000")
+                conn.exec_driver_sql("ANALYZE")
+            case "postgresql":
+                for table in ("file", "file_archive"):
+                    conn.exec_driver_sql(f"VACUUM (ANALYZE) {table}")
 
 
 """
@@ -799,15 +3560,21 @@ def get_max_lifespan(filesize: int) -> int:
 
 
 def do_vscan(f):
-    if f["path"].is_file():
-        with open(f["path"], "rb") as scanf:
-            try:
-                res = list(app.config["VSCAN_SOCKET"].instream(scanf).values())
-                f["result"] = res[0]
-            except:
-                f["result"] = ("SCAN FAILED", None)
-    else:
+    try:
+        if f["pack"]:
+            scanf = io.BytesIO(pack_store.read(*f["pack"]))
+        else:
+            scanf = storage_backend.open(f["sha256"])
+    except FileNotFoundError:
         f["result"] = ("FILE NOT FOUND", None)
+        return f
+
+    with scanf:
+        try:
+            res = list(app.config["VSCAN_SOCKET"].instream(scanf).values())
+            f["result"] = res[0]
+        except:
+            f["result"] = ("SCAN FAILED", None)
 
     return f
 
@@ -819,6 +3586,10 @@ def vscan():
               "specified.\nPlease set VSCAN_SOCKET.")
         sys.exit(1)
 
+    if isinstance(app.config["VSCAN_SOCKET"], str):
+        from clamd import ClamdUnixSocket
+        app.config["VSCAN_SOCKET"] = ClamdUnixSocket(app.config["VSCAN_SOCKET"])
+
     qp = Path(app.config["VSCAN_QUARANTINE_PATH"])
     qp.mkdir(parents=True, exist_ok=True)
 
@@ -833,9 +3604,19 @@ def vscan():
             res = File.query.filter(File.last_vscan == None,
                                     File.removed == False)
 
-        work = [{"path": f.getpath(), "name": f.getname(), "id": f.id}
+        work = [{"sha256": f.sha256, "name": f.getname(), "id": f.id,
+                 "pack": None if f.pack_segment is None
+                 else (f.pack_segment, f.pack_offset, f.size)}
                 for f in res]
 
+        # Results are written in batches, so uploads aren't kept waiting
+        # for the database while the whole scan runs
+        def save_results(results):
+            db.session.bulk_update_mappings(File, results)
+            if any(r["removed"] for r in results):
+                Generation.bump("removed", db.session.connection())
+            db.session.commit()
+
         results = []
         for i, r in enumerate(p.imap_unordered(do_vscan, work)):
             if r["result"][0] != "OK":
@@ -844,7 +3625,16 @@ def vscan():
             found = False
             if r["result"][0] == "FOUND":
                 if not r["result"][1] in app.config["VSCAN_IGNORE"]:
-                    r["path"].rename(qp / r["name"])
+                    dest = qp / r["name"]
+                    if r["pack"]:
+                        dest.write_bytes(pack_store.read(*r["pack"]))
+                    elif storage_backend.local:
+                        storage_layout.find(r["sha256"]).rename(dest)
+                    else:
+                        with storage_backend.open(r["sha256"]) as src, \
+                             open(dest, "wb") as dst:
+                            shutil.copyfileobj(src, dst)
+                        storage_backend.delete(r["sha256"])
                     found = True
 
             results.append({
@@ -853,5 +3643,365 @@ def vscan():
                 else datetime.datetime.now(),
                 "removed": found})
 
-        db.session.bulk_update_mappings(File, results)
+            if found and r["pack"]:
+                results[-1].update(pack_segment=None, pack_offset=None)
+
+            if len(results) == MAINTENANCE_BATCH_SIZE:
+                save_results(results)
+                results = []
+
+        save_results(results)
+
+
+@app.cli.command("nsfw-worker")
+@click.option("--batch-size", default=16, show_default=True,
+              help="Number of files to classify at once.")
+@click.option("--processes", default=None, type=int,
+              help="Number of processes decoding frames. Defaults to the "
+                   "number of CPUs.")
+@click.option("--interval", default=5.0, show_default=True,
+              help="Seconds to wait when the queue is empty.")
+@click.option("--once", is_flag=True,
+              help="Exit once the queue is empty.")
+def nsfw_worker(batch_size, processes, interval, once):
+    """
+    Score queued files with the NSFW detector
+
+    Frames are decoded by a pool of processes while the classifier runs on
+    whole batches of them in this process. Scores are written back in bulk.
+    """
+    if not app.config["NSFW_DETECT"]:
+        print("Error: NSFW_DETECT is not enabled.")
+        sys.exit(1)
+
+    import nsfw_detect
+    from multiprocessing import Pool
+
+    # Start the decoders before loading the model, so they don't inherit it
+    with Pool(processes) as p:
+        detector = nsfw_detect.NSFWDetector(app.config["NSFW_BACKEND"],
+                                            app.config["NSFW_ONNX_MODEL"],
+                                            app.config["NSFW_THREADS"],
+                                            batch_size)
+
+        while True:
+            jobs = db.session.scalars(
+                select(NSFWJob).order_by(NSFWJob.queued).limit(batch_size)
+            ).all()
+
+            if not jobs:
+                db.session.rollback()
+                if once:
+                    break
+                time.sleep(interval)
+                continue
+
+            ids = [j.file_id for j in jobs]
+            files = File.query.filter(File.id.in_(ids),
+                                      File.removed == False,
+                                      File.expiration != None).all()
+
+            # Small files are read from their pack here, as decoders can't
+            # open part of a segment
+            sources = [f.open() if f.pack_segment is not None
+                       else f.locate() for f in files]
+            scores = detector.detect_batch(sources, [f.mime for f in files],
+                                           app.config["NSFW_VIDEO_FRAMES"], p)
+
+            if files:
+                db.session.execute(update(File), [
+                    {"id": f.id, "nsfw_score": score}
+                    for f, score in zip(files, scores)])
+            db.session.execute(NSFWJob.__table__.delete()
+                               .where(NSFWJob.file_id.in_(ids)))
+            db.session.commit()
+
+            print(f"Scored {len(files)} file(s)")
+
+
+@app.cli.command("nsfw-scan")
+def nsfw_scan():
+    """
+    Queue all files that haven't been scored yet for the NSFW worker
+    """
+    now = time.time() * 1000
+    queued = select(NSFWJob.file_id)
+    pending = select(File.id, sa_literal(now)).where(
+        File.nsfw_score == None, File.removed == False,
+        File.expiration != None, File.id.not_in(queued))
+
+    res = db.session.execute(NSFWJob.__table__.insert().from_select(
+        ["file_id", "queued"], pending))
+    db.session.commit()
+
+    print(f"Queued {res.rowcount} file(s)")
+
+
+def run_fetch_job(job_id: int) -> None:
+    """
+    Fetches and stores the remote file of a claimed job
+
+    Runs in a thread of the fetch worker, with its own app context and so
+    its own database session. Progress is written back at most once a
+    second.
+    """
+    import requests
+
+    with app.app_context():
+        job = db.session.get(FetchJob, job_id)
+        last = 0
+
+        def progress(received, size):
+            nonlocal last
+            now = time.monotonic()
+            if now - last >= 1:
+                last = now
+                job.received = received
+                job.size = size
+                job.updated = time.time() * 1000
+                db.session.commit()
+
+        try:
+            sf, job.new = store_remote(job.url, job.addr, job.ua, job.secret,
+                                       progress)
+            job.received = job.size = sf.size
+            job.file_id = sf.id
+            job.state = "done"
+        except HTTPException as e:
+            db.session.rollback()
+            job.state = "failed"
+            job.code = e.code
+            job.error = e.description
+        except requests.exceptions.HTTPError as e:
+            db.session.rollback()
+            job.state = "failed"
+            job.code = 502
+            job.error = str(e)
+        except Exception as e:
+            db.session.rollback()
+            job.state = "failed"
+            job.code = 500
+            job.error = "Internal error."
+            print(f"Fetching {job.url} failed: {e!r}")
+
+        job.updated = time.time() * 1000
         db.session.commit()
+        print(f"Fetched {job.url}: {job.state}")
+
+
+@app.cli.command("fetch-worker")
+@click.option("--threads", default=4, show_default=True,
+              help="Number of files to fetch at once.")
+@click.option("--interval", default=1.0, show_default=True,
+              help="Seconds to wait when the queue is empty.")
+@click.option("--once", is_flag=True,
+              help="Exit once the queue is empty.")
+def fetch_worker(threads, interval, once):
+    """
+    Fetch URL uploads queued with the async option
+
+    Jobs are claimed atomically, so several workers can share the queue.
+    Jobs that stopped making progress, e.g. because their worker was killed,
+    are queued again.
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    stall = (app.config["FHOST_FETCH_MAX_TIME"] + 60) * 1000
+    running = set()
+
+    with ThreadPoolExecutor(threads) as pool:
+        while True:
+            running = {r for r in running if not r.done()}
+
+            db.session.execute(update(FetchJob).where(
+                FetchJob.state == "running",
+                FetchJob.updated < time.time() * 1000 - stall
+            ).values(state="queued"))
+
+            claimed = []
+            if len(running) < threads:
+                ids = db.session.scalars(
+                    select(FetchJob.id).where(FetchJob.state == "queued")
+                    .order_by(FetchJob.id).limit(threads - len(running))
+                ).all()
+
+                for id in ids:
+                    res = db.session.execute(update(FetchJob).where(
+                        FetchJob.id == id, FetchJob.state == "queued"
+                    ).values(state="running", updated=time.time() * 1000))
+                    if res.rowcount:
+                        claimed.append(id)
+            db.session.commit()
+
+            for id in claimed:
+                running.add(pool.submit(run_fetch_job, id))
+
+            if not claimed:
+                if running:
+                    wait(running, interval, FIRST_COMPLETED)
+                elif once:
+                    break
+                else:
+                    time.sleep(interval)
+
+
+storage_cli = AppGroup("storage", help="Manage the storage directory.")
+app.cli.add_command(storage_cli)
+
+
+@storage_cli.command("migrate-layout")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of files to move between pauses.")
+@click.option("--pause", default=0.1, show_default=True,
+              help="Seconds to wait between batches.")
+def migrate_layout(batch_size, pause):
+    """
+    Move stored files to the layout set by FHOST_STORAGE_FANOUT
+
+    Files are renamed one by one, so this can run while the service is up.
+    Until it has finished, files are also looked up in their old location.
+    If interrupted, simply run it again.
+    """
+    if not storage_backend.local:
+        print("Error: The storage layout only applies to the local "
+              "storage backend.")
+        sys.exit(1)
+
+    root = storage_layout.root
+    root.mkdir(parents=True, exist_ok=True)
+    digest_re = re.compile(r"[0-9a-f]{64}")
+    moved = 0
+    failed = 0
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Skip spools and anything else that isn't ours
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+
+        for name in filenames:
+            if not digest_re.fullmatch(name):
+                continue
+
+            src = Path(dirpath) / name
+            dest = storage_layout.path(name)
+            if src == dest:
+                continue
+
+            try:
+                if dest.is_file():
+                    src.unlink()  # Stored twice, e.g. by a racing upload
+                else:
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    src.rename(dest)
+            except OSError as e:
+                print(e)
+                failed += 1
+                continue
+
+            moved += 1
+            if moved % batch_size == 0:
+                print(f"Moved {moved} file(s)")
+                time.sleep(pause)
+
+    # Remove directories left over from a previous layout
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        rel = Path(dirpath).relative_to(root)
+        if rel.parts and not rel.parts[0].startswith(".") \
+                and not storage_layout.is_shard(rel):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # not empty
+
+    if failed:
+        print(f"Moved {moved} file(s), failed to move {failed}. "
+              "Fix the errors above, then run this again.")
+        sys.exit(1)
+
+    storage_layout.write_marker()
+    print(f"Done! Moved {moved} file(s)")
+
+
+def preload():
+    """
+    Sets up expensive state that all workers need
+
+    Under uWSGI, the application is imported by the master process before
+    it forks its workers (unless lazy-apps is enabled), so state created
+    here is shared between them copy-on-write instead of being rebuilt by
+    each of them. Database connections must not be shared between
+    processes, so they are closed afterwards.
+    """
+    get_mimedetect()
+
+    with app.app_context():
+        try:
+            removed_index.load()
+        except sqlalchemy.exc.OperationalError:
+            pass  # the database has not been set up yet
+        db.engine.dispose()
+
+
+@app.cli.command("startup-profile")
+@click.option("--top", default=20, show_default=True,
+              help="Number of modules to list.")
+def startup_profile(top):
+    """
+    Report the import time of each module and memory use at startup
+
+    Starts a fresh interpreter that imports the application and preloads
+    shared state the way a worker would.
+    """
+    import subprocess
+
+    code = """if True:
+        import resource
+
+        def rss():
+            try:
+                with open("/proc/self/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            return int(line.split()[1])
+            except OSError:
+                pass
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        print(rss())
+        import fhost
+        print(rss())
+        fhost.preload()
+        print(rss())
+    """
+
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                         capture_output=True, text=True,
+                         cwd=Path(__file__).parent)
+    if res.returncode:
+        print(res.stderr)
+        sys.exit(1)
+
+    modules = []
+    for line in res.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, cumulative, name = line[12:].split("|")
+            if self_us.strip().isdigit():
+                modules.append((int(self_us), int(cumulative),
+                                name.strip()))
+
+    print(f"{'self [ms]':>10} {'cumulative [ms]':>16}  module")
+    for self_us, cumulative, name in sorted(modules, reverse=True)[:top]:
+        print(f"{self_us / 1000:10.1f} {cumulative / 1000:16.1f}  {name}")
+
+    total = sum(m[0] for m in modules)
+    base, imported, preloaded = map(int, res.stdout.split())
+    print(f"\nTotal import time: {total / 1000:.1f} ms")
+    print(f"RSS: {base / 1024:.1f} MiB at interpreter start, "
+          f"{imported / 1024:.1f} MiB after import, "
+          f"{preloaded / 1024:.1f} MiB after preload")
+
+
+try:
+    import uwsgi  # noqa: F401
+    preload()
+except ImportError:
+    pass
@@ -29,6 +29,24 @@
 # resolved.
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + '/opt/render/project/src/database.sqlite'
 
+# Pragmas applied to every SQLite connection
+#
+# The defaults let many workers upload while maintenance commands like prune
+# and vscan write to the database: WAL lets reads proceed during writes,
+# synchronous = NORMAL makes commits cheap without risking corruption, and
+# writers wait up to busy_timeout milliseconds for each other instead of
+# failing with "database is locked". mmap_size lets SQLite read the database
+# through shared memory mappings. Set this to {} to leave SQLite's defaults.
+#
+# Once enabled, WAL persists in the database file. The database directory
+# must be writable for the -wal and -shm files next to it.
+FHOST_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 10000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
 
 # The maximum allowable upload size, in bytes
 #
@@ -94,6 +112,68 @@ FHOST_USE_X_ACCEL_REDIRECT = True # expect nginx by default
 # resolved relative to the working directory that 0x0 is being run from.
 FHOST_STORAGE_PATH = "up"
 
+# How to spread files over subdirectories of FHOST_STORAGE_PATH
+#
+# Each number is the length of a SHA-256 prefix used as a directory name, so
+# (2, 2) stores files as up/ab/cd/abcd…, keeping directories small even with
+# millions of files. An empty tuple stores all files directly in
+# FHOST_STORAGE_PATH.
+#
+# After changing this, run `flask storage migrate-layout` to move existing
+# files. It can run while 0x0 is up; files are looked up in their old
+# location until it has finished. With nginx, keep the `location` for
+# FHOST_STORAGE_PATH a prefix match so it covers the subdirectories.
+FHOST_STORAGE_FANOUT = ()
+
+# Files smaller than this many bytes are packed into large segment files in
+# FHOST_STORAGE_PATH/.pack instead of being stored one per file, which saves
+# inodes and speeds up backups when there are lots of tiny pastes. Set it to
+# e.g. 64 * 1024 to enable this; 0 disables it. Packed files are always
+# served by 0x0 itself, even with FHOST_USE_X_ACCEL_REDIRECT.
+FHOST_PACK_THRESHOLD = 0
+
+# A new segment is started once the current one would grow past this size
+FHOST_PACK_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# `flask prune` rewrites segments in which less than this fraction of the
+# space is used by files that haven't expired or been removed
+FHOST_PACK_COMPACT_RATIO = 0.5
+
+
+# Where uploaded files are kept
+#
+# "local" stores them in FHOST_STORAGE_PATH. "s3" stores them in a bucket of
+# an S3-compatible object store such as AWS S3, MinIO or Ceph, which needs
+# the boto3 package. Uploads are still spooled to FHOST_STORAGE_PATH while
+# they are received, and FHOST_PACK_THRESHOLD only applies to "local".
+FHOST_STORAGE_BACKEND = "local"
+
+# The bucket to use with the "s3" backend, and a prefix for object names.
+# If FHOST_S3_ENDPOINT is None, AWS is used. Credentials can also be set up
+# the usual way for boto3, e.g. with AWS_ACCESS_KEY_ID and
+# AWS_SECRET_ACCESS_KEY in the environment.
+#
+# FHOST_S3_ENDPOINT = "http://127.0.0.1:9000"
+FHOST_S3_BUCKET = None
+FHOST_S3_PREFIX = ""
+FHOST_S3_ENDPOINT = None
+FHOST_S3_REGION = None
+FHOST_S3_ACCESS_KEY = None
+FHOST_S3_SECRET_KEY = None
+
+# Each worker keeps up to this many connections to the object store open.
+# Files larger than FHOST_S3_PART_SIZE are uploaded in parts of that size.
+FHOST_S3_MAX_CONNECTIONS = 10
+FHOST_S3_PART_SIZE = 16 * 1024 * 1024
+
+# If True, downloads are redirected to presigned URLs valid for
+# FHOST_S3_URL_EXPIRY seconds, so clients fetch files from the object store
+# directly. Otherwise, 0x0 streams files from the object store itself,
+# including byte ranges, which is what you want if the object store is not
+# reachable from the internet.
+FHOST_S3_REDIRECT = True
+FHOST_S3_URL_EXPIRY = 60 * 60
+
 
 # The maximum acceptable user-specified file extension
 #
@@ -141,7 +221,9 @@ FHOST_EXT_OVERRIDE = {
 
 # Enables support for detecting NSFW images
 #
-# Consult README.md for additional dependencies before setting to True
+# Consult README.md for additional dependencies before setting to True.
+# Files are scored in the background by "flask nsfw-worker", which needs to
+# be running for this to have any effect.
 NSFW_DETECT = False
 
 
@@ -155,6 +237,22 @@ NSFW_DETECT = False
 NSFW_THRESHOLD = 0.92
 
 
+# How the NSFW classifier is run
+#
+# "torch" uses the PyTorch model directly. "onnx" runs an ONNX export of it
+# with ONNX Runtime, which is usually a lot faster on CPUs, especially when
+# quantized to int8. See README.rst for how to create one, and set
+# NSFW_ONNX_MODEL to its path. NSFW_THREADS limits the number of threads used
+# for inference; None lets the backend decide.
+NSFW_BACKEND = "torch"
+NSFW_ONNX_MODEL = None
+NSFW_THREADS = None
+
+
+# How many frames of a video are classified. The highest score is used.
+NSFW_VIDEO_FRAMES = 1
+
+
 # If you want to scan files for viruses using ClamAV, specify the socket used
 # for connections here. You will need the clamd module.
 # Since this can take a very long time on larger files, it is not done
@@ -162,9 +260,11 @@ NSFW_THRESHOLD = 0.92
 # configure a systemd timer or cronjob to do this periodically.
 # Remember to adjust your size limits in clamd.conf, including StreamMaxLength!
 #
+# This can either be the path of clamd's UNIX socket, or any clamd connection
+# object. Note that importing clamd here makes every worker load it.
+#
 # Example:
-# from clamd import ClamdUnixSocket
-# VSCAN_SOCKET = ClamdUnixSocket("/run/clamav/clamd-socket")
+# VSCAN_SOCKET = "/run/clamav/clamd-socket"
 
 # This is the directory that files flagged as malicious are moved to.
 # Relative paths are resolved relative to the working directory
@@ -186,6 +286,100 @@ VSCAN_IGNORE = [
     "PUA.Win.Packer.XmMusicFile",
 ]
 
+# How far ahead, in seconds, "flask prune --daemon" keeps track of upcoming
+# expirations. Changing the expiration of a file to within this window makes
+# the daemon reload it, which is cheap as long as the window is short.
+FHOST_PRUNE_HORIZON = 15 * 60
+
+# "flask db-compact" moves files that expired longer ago than this from the
+# file table to a much smaller archive table, which is enough to refuse
+# banned files and restore files uploaded again. The time is in milliseconds.
+FHOST_ARCHIVE_AFTER = 365 * 24 * 60 * 60 * 1000
+
+# Resumable uploads that haven't received any data for this long are removed
+# by the prune command. The time is in milliseconds.
+FHOST_UPLOAD_SESSION_TTL = 24 * 60 * 60 * 1000
+
+# Uploads are spooled in the storage directory while they are received.
+# Spools that haven't been written to for this long were left behind by
+# workers that crashed or were killed, and are removed by the prune command.
+# This has to be longer than any upload or fetch may stall. The time is in
+# milliseconds.
+FHOST_SPOOL_TTL = 60 * 60 * 1000
+
+# Each worker keeps an index of banned files in memory, so reuploads of them
+# can be refused quickly. Files banned by other processes (e.g. the moderation
+# UI or vscan) are picked up after at most this many seconds. So are files
+# deleted by other processes before they expired.
+FHOST_REMOVED_INDEX_INTERVAL = 10
+
+# Each worker caches what it needs to know to serve up to this many files, so
+# popular files don't cause database queries on every request. Changes made
+# by other processes (apart from bans and deletions, which are picked up like
+# described above) can take up to FHOST_FILE_CACHE_TTL seconds to become
+# visible.
+FHOST_FILE_CACHE_SIZE = 10000
+FHOST_FILE_CACHE_TTL = 30
+
+# Files are served with an ETag and a Cache-Control header allowing clients
+# and proxies to keep them until they expire. Short URLs never change, so
+# their redirects are permanent (301) and may be cached for this many
+# seconds. Set this to None to send uncached 302 redirects instead.
+FHOST_REDIRECT_MAX_AGE = 24 * 60 * 60
+
+# Each worker remembers the targets of up to this many short URLs
+FHOST_URL_CACHE_SIZE = 10000
+
+# If set, each worker logs how many lookups its file and URL caches answered
+# at most this often, in seconds, so you can tell whether the cache sizes
+# above fit your traffic
+FHOST_CACHE_STATS_INTERVAL = None
+
+# The maximum number of URLs that can be shortened with a single request
+FHOST_MAX_SHORTEN_URLS = 100
+
+# Timeouts for fetching files uploaded by URL, in seconds
+#
+# The first value limits connecting to the remote server, the second how long
+# to wait for any data from it. Downloads that take longer than
+# FHOST_FETCH_MAX_TIME altogether are aborted as well.
+FHOST_FETCH_TIMEOUT = (5, 30)
+FHOST_FETCH_MAX_TIME = 5 * 60
+
+# Each worker keeps up to this many connections per remote host open for
+# fetching files uploaded by URL
+FHOST_FETCH_POOL_SIZE = 10
+
+# Remote files are fetched following at most this many redirects
+FHOST_FETCH_MAX_REDIRECTS = 5
+
+# Files fetched from remote URLs are remembered, so they don't need to be
+# downloaded again when the same URL is uploaded. For this many seconds after
+# fetching a URL, it is assumed to still point to the same file. After that,
+# the remote server is asked whether the file changed since. Set this to 0
+# to always ask.
+FHOST_FETCH_CACHE_TTL = 60 * 60
+
+# Allow URL uploads to be fetched in the background
+#
+# Clients opt in by sending "async" along with the URL and get a status URL
+# to poll instead of waiting for the download. Jobs are processed by the
+# fetch-worker command, so only enable this if it is running:
+#
+#   $ FLASK_APP=fhost flask fetch-worker --threads 4
+#
+# Otherwise URL uploads are always fetched while the client waits.
+FHOST_FETCH_ASYNC = False
+
+# The maximum number of background fetches that may be queued or running,
+# altogether and for each client address
+FHOST_FETCH_MAX_JOBS = 100
+FHOST_FETCH_MAX_JOBS_PER_ADDR = 3
+
+# Finished background fetches are reported on for this long before the prune
+# command removes them. The time is in milliseconds.
+FHOST_FETCH_JOB_TTL = 24 * 60 * 60 * 1000
+
 # A list of all characters which can appear in a URL
 #
 # If this list is too short, then URLs can very quickly become long.
@@ -65,6 +65,15 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # Indexes on expressions don't survive reflection, so they would always
+    # look changed. See pattern_index in fhost.py.
+    def include_object(object, name, type_, reflected, compare_to):
+        if type_ == 'index':
+            index = compare_to if reflected else object
+            if index is not None and index.info.get('skip_autogenerate'):
+                return False
+        return True
+
     engine = engine_from_config(config.get_section(config.config_ini_section),
                                 prefix='sqlalchemy.',
                                 poolclass=pool.NullPool)
@@ -73,6 +82,7 @@ def run_migrations_online():
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      include_object=include_object,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
@@ -0,0 +1,26 @@
+"""Add NSFW job queue
+
+Revision ID: 1e8a3c7d5f60
+Revises: b3f04a6e9d21
+Create Date: 2026-10-18 11:48:55.104387
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1e8a3c7d5f60'
+down_revision = 'b3f04a6e9d21'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('nsfw_job',
+                    sa.Column('file_id', sa.Integer(), nullable=False),
+                    sa.Column('queued', sa.BigInteger(), nullable=True),
+                    sa.ForeignKeyConstraint(['file_id'], ['file.id']),
+                    sa.PrimaryKeyConstraint('file_id'))
+
+
+def downgrade():
+    op.drop_table('nsfw_job')
@@ -0,0 +1,31 @@
+"""Add pack store locations to files
+
+Revision ID: 4a7d2c9e1b83
+Revises: 1e8a3c7d5f60
+Create Date: 2026-10-18 14:02:37.512966
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7d2c9e1b83'
+down_revision = '1e8a3c7d5f60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pack_segment', sa.Integer(),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('pack_offset', sa.BigInteger(),
+                                      nullable=True))
+        batch_op.create_index(batch_op.f('ix_file_pack_segment'),
+                              ['pack_segment'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_pack_segment'))
+        batch_op.drop_column('pack_offset')
+        batch_op.drop_column('pack_segment')
@@ -0,0 +1,50 @@
+"""Add fetch jobs
+
+Revision ID: 5b9e3f2a7c14
+Revises: 8d2f6b1c4e57
+Create Date: 2026-10-18 16:40:52.318907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b9e3f2a7c14'
+down_revision = '8d2f6b1c4e57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('fetch_job',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('token', sa.String(), nullable=False),
+                    sa.Column('url', sa.UnicodeText(), nullable=False),
+                    sa.Column('secret', sa.Boolean(), nullable=True),
+                    sa.Column('addr', sa.LargeBinary(length=16),
+                              nullable=True),
+                    sa.Column('ua', sa.UnicodeText(), nullable=True),
+                    sa.Column('state', sa.String(length=8), nullable=False),
+                    sa.Column('received', sa.BigInteger(), nullable=True),
+                    sa.Column('size', sa.BigInteger(), nullable=True),
+                    sa.Column('file_id', sa.Integer(), nullable=True),
+                    sa.Column('new', sa.Boolean(), nullable=True),
+                    sa.Column('code', sa.Integer(), nullable=True),
+                    sa.Column('error', sa.UnicodeText(), nullable=True),
+                    sa.Column('updated', sa.BigInteger(), nullable=True),
+                    sa.ForeignKeyConstraint(['file_id'], ['file.id']),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('token'))
+
+    with op.batch_alter_table('fetch_job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_fetch_job_addr'), ['addr'],
+                              unique=False)
+        batch_op.create_index(batch_op.f('ix_fetch_job_state'), ['state'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('fetch_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_fetch_job_state'))
+        batch_op.drop_index(batch_op.f('ix_fetch_job_addr'))
+
+    op.drop_table('fetch_job')
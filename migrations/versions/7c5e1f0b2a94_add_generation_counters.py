@@ -0,0 +1,29 @@
+"""Add generation counters
+
+Revision ID: 7c5e1f0b2a94
+Revises: d9a53a28ba54
+Create Date: 2026-10-18 10:12:41.306517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c5e1f0b2a94'
+down_revision = 'd9a53a28ba54'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    generation = op.create_table('generation',
+                                 sa.Column('name', sa.String(length=32),
+                                           nullable=False),
+                                 sa.Column('value', sa.BigInteger(),
+                                           nullable=False),
+                                 sa.PrimaryKeyConstraint('name'))
+
+    op.bulk_insert(generation, [{"name": "request_filter", "value": 1}])
+
+
+def downgrade():
+    op.drop_table('generation')
@@ -0,0 +1,58 @@
+"""Add URL hashes
+
+Revision ID: 8d2f6b1c4e57
+Revises: 4a7d2c9e1b83
+Create Date: 2026-10-18 15:21:09.774203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2f6b1c4e57'
+down_revision = '4a7d2c9e1b83'
+
+from alembic import op
+from hashlib import sha256
+import sqlalchemy as sa
+
+
+# Number of URLs hashed per round trip
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sha256', sa.String(length=64),
+                                      nullable=True))
+
+    bind = op.get_bind()
+    url = sa.table('URL',
+                   sa.column('id', sa.Integer),
+                   sa.column('url', sa.UnicodeText),
+                   sa.column('sha256', sa.String))
+    update = url.update().where(url.c.id == sa.bindparam('_id')) \
+                .values(sha256=sa.bindparam('_sha256'))
+
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select(url.c.id, url.c.url)
+                            .where(url.c.id > last_id,
+                                   url.c.url.is_not(None))
+                            .order_by(url.c.id)
+                            .limit(BATCH_SIZE)).all()
+        if not rows:
+            break
+
+        bind.execute(update, [{'_id': id,
+                               '_sha256': sha256(u.encode()).hexdigest()}
+                              for id, u in rows])
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_URL_sha256'), ['sha256'],
+                              unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('URL', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_URL_sha256'))
+        batch_op.drop_column('sha256')
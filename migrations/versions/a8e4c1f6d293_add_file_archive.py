@@ -0,0 +1,49 @@
+"""Add file archive
+
+Revision ID: a8e4c1f6d293
+Revises: f3b7a9c2d815
+Create Date: 2026-10-18 19:41:27.318650
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a8e4c1f6d293'
+down_revision = 'f3b7a9c2d815'
+
+from alembic import op
+import sqlalchemy as sa
+import time
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('expired_at', sa.BigInteger(),
+                                      nullable=True))
+        batch_op.create_index(batch_op.f('ix_file_expired_at'),
+                              ['expired_at'], unique=False)
+
+    # When files that are already gone expired isn't known, so they start
+    # counting from now
+    file = sa.table('file', sa.column('expiration'),
+                    sa.column('expired_at'))
+    op.execute(file.update().where(file.c.expiration.is_(None))
+               .values(expired_at=int(time.time() * 1000)))
+
+    op.create_table('file_archive',
+                    sa.Column('id', sa.Integer(), autoincrement=False,
+                              nullable=False),
+                    sa.Column('sha256', sa.String(), nullable=False),
+                    sa.Column('removed', sa.Boolean(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('sha256'))
+
+
+def downgrade():
+    # Archived files go back without their metadata
+    op.execute('INSERT INTO file (id, sha256, removed) '
+               'SELECT id, sha256, removed FROM file_archive')
+    op.drop_table('file_archive')
+
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_expired_at'))
+        batch_op.drop_column('expired_at')
@@ -0,0 +1,46 @@
+"""Add resumable upload sessions
+
+Revision ID: b3f04a6e9d21
+Revises: 7c5e1f0b2a94
+Create Date: 2026-10-18 11:02:17.582044
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3f04a6e9d21'
+down_revision = '7c5e1f0b2a94'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('upload_session',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('token', sa.String(), nullable=False),
+                    sa.Column('size', sa.BigInteger(), nullable=False),
+                    sa.Column('filename', sa.UnicodeText(), nullable=True),
+                    sa.Column('mime', sa.UnicodeText(), nullable=True),
+                    sa.Column('requested_expiration', sa.BigInteger(),
+                              nullable=True),
+                    sa.Column('secret', sa.Boolean(), nullable=True),
+                    sa.Column('addr', sa.LargeBinary(length=16),
+                              nullable=True),
+                    sa.Column('ua', sa.UnicodeText(), nullable=True),
+                    sa.Column('updated', sa.BigInteger(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('token'))
+
+    op.create_table('upload_chunk',
+                    sa.Column('session_id', sa.Integer(), nullable=False),
+                    sa.Column('offset', sa.BigInteger(), nullable=False),
+                    sa.Column('length', sa.BigInteger(), nullable=False),
+                    sa.Column('sha256', sa.String(), nullable=False),
+                    sa.ForeignKeyConstraint(['session_id'],
+                                            ['upload_session.id']),
+                    sa.PrimaryKeyConstraint('session_id', 'offset'))
+
+
+def downgrade():
+    op.drop_table('upload_chunk')
+    op.drop_table('upload_session')
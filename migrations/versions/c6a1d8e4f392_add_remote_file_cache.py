@@ -0,0 +1,40 @@
+"""Add remote file cache
+
+Revision ID: c6a1d8e4f392
+Revises: 5b9e3f2a7c14
+Create Date: 2026-10-18 17:26:03.640185
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c6a1d8e4f392'
+down_revision = '5b9e3f2a7c14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('remote_file',
+                    sa.Column('url_hash', sa.String(length=64),
+                              nullable=False),
+                    sa.Column('url', sa.UnicodeText(), nullable=False),
+                    sa.Column('sha256', sa.String(length=64),
+                              nullable=False),
+                    sa.Column('size', sa.BigInteger(), nullable=False),
+                    sa.Column('etag', sa.UnicodeText(), nullable=True),
+                    sa.Column('last_modified', sa.UnicodeText(),
+                              nullable=True),
+                    sa.Column('fetched', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('url_hash'))
+
+    with op.batch_alter_table('remote_file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_remote_file_sha256'),
+                              ['sha256'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('remote_file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_remote_file_sha256'))
+
+    op.drop_table('remote_file')
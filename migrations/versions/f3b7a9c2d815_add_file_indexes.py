@@ -0,0 +1,52 @@
+"""Add indexes for prune, vscan and moderation queries
+
+Revision ID: f3b7a9c2d815
+Revises: c6a1d8e4f392
+Create Date: 2026-10-18 18:12:44.905327
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3b7a9c2d815'
+down_revision = 'c6a1d8e4f392'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Columns the moderation interface filters on with LIKE
+PATTERN_COLUMNS = ['mime', 'ext', 'ua']
+
+
+def upgrade():
+    # Only files that are still stored can expire
+    op.create_index('ix_file_expiration', 'file', ['expiration'],
+                    sqlite_where=sa.text('expiration IS NOT NULL'),
+                    postgresql_where=sa.text('expiration IS NOT NULL'))
+    op.create_index('ix_file_removed_last_vscan', 'file',
+                    ['removed', 'last_vscan'])
+    op.create_index(op.f('ix_file_addr'), 'file', ['addr'])
+    op.create_index(op.f('ix_file_size'), 'file', ['size'])
+    op.create_index(op.f('ix_file_nsfw_score'), 'file', ['nsfw_score'])
+
+    dialect = op.get_bind().dialect.name
+    for column in PATTERN_COLUMNS:
+        if dialect == 'sqlite':
+            # LIKE is case-insensitive in SQLite, so only a NOCASE index
+            # can serve it
+            op.create_index(f'ix_file_{column}', 'file',
+                            [sa.text(f'{column} COLLATE NOCASE')])
+        else:
+            op.create_index(f'ix_file_{column}', 'file', [column],
+                            postgresql_ops={column: 'text_pattern_ops'})
+
+
+def downgrade():
+    for column in reversed(PATTERN_COLUMNS):
+        op.drop_index(f'ix_file_{column}', table_name='file')
+
+    op.drop_index(op.f('ix_file_nsfw_score'), table_name='file')
+    op.drop_index(op.f('ix_file_size'), table_name='file')
+    op.drop_index(op.f('ix_file_addr'), table_name='file')
+    op.drop_index('ix_file_removed_last_vscan', table_name='file')
+    op.drop_index('ix_file_expiration', table_name='file')
@@ -2,6 +2,7 @@
 
 from itertools import zip_longest
 from sys import stdout
+import io
 import time
 
 from textual.app import App, ComposeResult
@@ -113,7 +114,7 @@ class NullptrMod(Screen):
                 tsize = 0
                 trm = 0
                 for f in File.query.filter(File.addr == addr):
-                    if f.getpath().is_file():
+                    if f.exists():
                         tsize += f.size or f.getpath().stat().st_size
                         trm += 1
                     f.delete(True)
@@ -169,20 +170,27 @@ class NullptrMod(Screen):
 
     def handle_libarchive(self, cat):
         import libarchive
-        with libarchive.file_reader(str(self.current_file.getpath())) as a:
+        with self.current_file.open() as af, \
+             libarchive.stream_reader(af) as a:
             self.ftlog.write("\n".join(e.path for e in a))
         return True
 
     def handle_text(self, cat):
-        with open(self.current_file.getpath(), "r") as sf:
+        with io.TextIOWrapper(self.current_file.open()) as sf:
             data = sf.read(1000000).replace("\033", "")
             self.ftlog.write(data)
         return True
 
     def handle_mupdf(self, cat):
         import fitz
-        with fitz.open(self.current_file.getpath(),
-                       filetype=self.current_file.ext.lstrip(".")) as doc:
+        f = self.current_file
+        if f.pack_segment is None and f.getpath().is_file():
+            doc = fitz.open(f.getpath(), filetype=f.ext.lstrip("."))
+        else:
+            with f.open() as pf:
+                doc = fitz.open(stream=pf.read(), filetype=f.ext.lstrip("."))
+
+        with doc:
             p = doc.load_page(0)
             pix = p.get_pixmap(dpi=72)
             imgdata = pix.tobytes("ppm").hex()
@@ -203,12 +211,17 @@ class NullptrMod(Screen):
         return True
 
     def handle_mpv(self, cat):
-        if cat == mime.MIMECategory.AV or self.current_file.nsfw_score >= 0:
+        score = self.current_file.nsfw_score
+        if cat == mime.MIMECategory.AV or (score is not None and score >= 0):
             self.mpvw.styles.height = "20%"
-            self.mpvw.start_mpv(str(self.current_file.getpath()), 0)
+            if self.current_file.pack_segment is None:
+                self.mpvw.start_mpv(self.current_file.locate(), 0)
+            else:
+                with self.current_file.open() as pf:
+                    self.mpvw.start_mpv("hex://" + pf.read().hex(), 0)
 
             import av
-            with av.open(str(self.current_file.getpath())) as c:
+            with self.current_file.open() as af, av.open(af) as c:
                 self.ftlog.write(Text("Format:", style="bold"))
                 self.ftlog.write(f"  {c.format.long_name}")
                 if len(c.metadata):
@@ -254,7 +267,7 @@ class NullptrMod(Screen):
                         zip_longest(
                             *[iter(binf.read(min(length, 16 * 10)))] * 16))))
 
-        with open(self.current_file.getpath(), "rb") as binf:
+        with self.current_file.open() as binf:
             self.ftlog.write(hexdump(binf, self.current_file.size))
             if self.current_file.size > 16*10*2:
                 binf.seek(self.current_file.size-16*10)
@@ -294,7 +307,7 @@ class NullptrMod(Screen):
         self.mpvw.stop_mpv(True)
         self.ftlog.clear()
 
-        if f.getpath().is_file():
+        if f.exists():
             self.mimehandler.handle(f.mime, f.ext)
             self.ftlog.scroll_to(x=0, y=0, animate=False)
 
@@ -41,7 +41,7 @@ class FileTable(DataTable):
                 str(f.id),
                 "🔴" if f.removed else "  ",
                 "🚩" if f.is_nsfw else "  ",
-                "👻" if not f.getpath().is_file() else "  ",
+                "👻" if not f.exists() else "  ",
                 f.getname(),
                 do_filesizeformat(f.size, True),
                 f"{mimemoji} {f.mime}",
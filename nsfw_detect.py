@@ -18,37 +18,197 @@
     and limitations under the License.
 """
 
+import argparse
 import sys
+import time
 import av
-from transformers import pipeline
+
+MODEL = "giacomoarienti/nsfw-classifier"
+
+
+def is_visual(mime):
+    """
+    Whether a MIME type is worth decoding frames from
+    """
+    return mime.split("/")[0] in ("image", "video")
+
+
+def downscale(frame, size):
+    scale = size / max(frame.width, frame.height)
+    if scale >= 1:
+        return frame.to_image()
+
+    return frame.to_image(width=max(1, round(frame.width * scale)),
+                          height=max(1, round(frame.height * scale)))
+
+
+def extract_frames(fpath, count=1, size=384):
+    """
+    Decodes up to count keyframes spread evenly over an image or video file
+
+    Only keyframes are decoded, and they are downscaled so their longest side
+    is at most size pixels, which is still plenty for the classifier. Returns
+    an empty list if the file can't be decoded. This doesn't need the
+    classifier, so it can run in worker processes.
+    """
+    frames = []
+
+    try:
+        with av.open(fpath) as container:
+            stream = container.streams.video[0]
+            stream.codec_context.skip_frame = "NONKEY"
+
+            if container.duration:
+                positions = [container.duration * (i + 1) // (count + 1)
+                             for i in range(count)]
+            else:
+                positions = [None]
+
+            for pos in positions:
+                if pos is not None:
+                    try:
+                        container.seek(pos)
+                    except av.error.FFmpegError:
+                        container.seek(0)
+
+                frame = next(container.decode(stream), None)
+                if frame is not None:
+                    frames.append(downscale(frame, size))
+    except (av.error.FFmpegError, IndexError, OSError):
+        pass
+
+    return frames
 
 
 class NSFWDetector:
-    def __init__(self):
-        self.classifier = pipeline("image-classification",
-                                   model="giacomoarienti/nsfw-classifier")
+    """
+    Scores images and videos using an image classification model
 
-    def detect(self, fpath):
-        try:
-            with av.open(fpath) as container:
-                try:
-                    container.seek(int(container.duration / 2))
-                except: container.seek(0)
+    The "torch" backend runs the model through a transformers pipeline. The
+    "onnx" backend runs an ONNX export of the same model, for instance an
+    int8-quantized one, with ONNX Runtime. threads limits the number of
+    threads used for inference.
+    """
+    def __init__(self, backend="torch", onnx_model=None, threads=None,
+                 batch_size=16):
+        self.backend = backend
+        self.batch_size = batch_size
+
+        if backend == "torch":
+            import torch
+            from transformers import pipeline
 
-                frame = next(container.decode(video=0))
-                img = frame.to_image()
-                res = self.classifier(img)
+            if threads:
+                torch.set_num_threads(threads)
+            self.classifier = pipeline("image-classification", model=MODEL)
+        elif backend == "onnx":
+            import onnxruntime
+            from transformers import AutoConfig, AutoImageProcessor
 
-                return max([x["score"] for x in res
-                            if x["label"] not in ["neutral", "drawings"]])
-        except: pass
+            opts = onnxruntime.SessionOptions()
+            if threads:
+                opts.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(
+                onnx_model, opts, providers=["CPUExecutionProvider"])
+            self.processor = AutoImageProcessor.from_pretrained(MODEL)
+            self.labels = AutoConfig.from_pretrained(MODEL).id2label
+        else:
+            raise ValueError(f"Unknown NSFW detection backend: {backend}")
 
-        return -1.0
+    def _run(self, images):
+        if self.backend == "torch":
+            return [{x["label"]: x["score"] for x in res}
+                    for res in self.classifier(images,
+                                               batch_size=self.batch_size)]
+
+        import numpy as np
+
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            inputs = self.processor(images[i:i + self.batch_size],
+                                    return_tensors="np")
+            logits = self.session.run(
+                None, {"pixel_values": inputs["pixel_values"]})[0]
+            exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probs = exp / exp.sum(axis=1, keepdims=True)
+            results += [{self.labels[j]: float(p) for j, p in enumerate(row)}
+                        for row in probs]
+        return results
+
+    def classify(self, images):
+        """
+        Scores a list of images
+        """
+        if not images:
+            return []
+
+        return [max(score for label, score in res.items()
+                    if label not in ["neutral", "drawings"])
+                for res in self._run(images)]
+
+    def detect_batch(self, paths, mimes=None, frames=1, pool=None):
+        """
+        Scores a batch of files
+
+        Files whose MIME type is known not to be an image or video aren't
+        opened at all. Up to the given number of frames are taken from each
+        video, and the highest of their scores is used. If a pool is given,
+        decoding is spread over it. Files without any usable frames get a
+        score of -1.0. Instead of paths, in-memory file objects such as
+        BytesIO may be passed.
+        """
+        mimes = mimes or [None] * len(paths)
+        todo = [p for p, m in zip(paths, mimes) if m is None or is_visual(m)]
+
+        if pool:
+            decoded = pool.starmap(extract_frames,
+                                   [(p, frames) for p in todo])
+        else:
+            decoded = [extract_frames(p, frames) for p in todo]
+
+        images = [img for f in decoded for img in f]
+        scores = iter(self.classify(images))
+        results = {p: max([next(scores) for _ in f], default=-1.0)
+                   for p, f in zip(todo, decoded)}
+
+        return [results.get(p, -1.0) for p in paths]
+
+    def detect(self, fpath):
+        return self.detect_batch([fpath])[0]
 
 
 if __name__ == "__main__":
-    n = NSFWDetector()
+    parser = argparse.ArgumentParser(
+        description="Score files and measure classification throughput")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--backend", choices=["torch", "onnx", "both"],
+                        default="torch")
+    parser.add_argument("--onnx-model", help="Path to the ONNX export")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--frames", type=int, default=1,
+                        help="Frames to sample per video")
+    args = parser.parse_args()
+
+    backends = ["torch", "onnx"] if args.backend == "both" else [args.backend]
+
+    for backend in backends:
+        n = NSFWDetector(backend, args.onnx_model, args.threads,
+                         args.batch_size)
+
+        start = time.perf_counter()
+        decoded = [extract_frames(f, args.frames) for f in args.files]
+        decode_time = time.perf_counter() - start
+
+        images = [img for f in decoded for img in f]
+        start = time.perf_counter()
+        scores = iter(n.classify(images))
+        infer_time = time.perf_counter() - start
+
+        for inf, f in zip(args.files, decoded):
+            print(backend, inf, max([next(scores) for _ in f], default=-1.0))
 
-    for inf in sys.argv[1:]:
-        score = n.detect(inf)
-        print(inf, score)
+        print(f"{backend}: {len(images)} image(s), decoding "
+              f"{len(images) / decode_time:.1f} images/s, inference "
+              f"{len(images) / max(infer_time, 1e-9):.1f} images/s",
+              file=sys.stderr)
@@ -0,0 +1,62 @@
+"""
+    Fixtures shared by the tests
+
+    fhost reads its configuration when it is imported, so it is imported
+    from a throwaway instance in a temporary directory, like the benchmarks
+    in bench/ do. Each test starts with empty tables and storage.
+"""
+
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def fhost(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("fhost")
+    (tmp / "fhost.py").symlink_to(ROOT / "fhost.py")
+    (tmp / "templates").symlink_to(ROOT / "templates")
+    (tmp / "instance").mkdir()
+    (tmp / "instance" / "config.py").write_text("\n".join([
+        f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp / 'db.sqlite'}'",
+        f"FHOST_STORAGE_PATH = '{tmp / 'up'}'",
+        "FHOST_USE_X_ACCEL_REDIRECT = False",
+        "SERVER_NAME = 'localhost'",
+    ]) + "\n")
+
+    sys.path.insert(0, str(tmp))
+    import fhost
+
+    return fhost
+
+
+@pytest.fixture
+def app(fhost):
+    storage = Path(fhost.app.config["FHOST_STORAGE_PATH"])
+    storage.mkdir()
+
+    with fhost.app.app_context():
+        fhost.db.create_all()
+
+    yield fhost.app
+
+    with fhost.app.app_context():
+        fhost.db.drop_all()
+
+    shutil.rmtree(storage)
+
+    # Forget what this worker remembers about the previous test's files
+    fhost.file_cache.clear()
+    fhost.url_cache.clear()
+    fhost.removed_index.bloom = None
+    fhost._request_filters = (None, None)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
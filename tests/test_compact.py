@@ -0,0 +1,64 @@
+"""
+    Tests for archiving long expired files
+"""
+
+import hashlib
+import io
+import ipaddress
+from urllib.parse import urlsplit
+
+from sqlalchemy import update
+
+FILES = [b"archived " * 100, b"fetched " * 100, b"banned " * 100,
+         b"newest " * 100]
+
+
+def upload(client, data: bytes):
+    r = client.post("/", data={"file": (io.BytesIO(data), "file.txt")})
+    return r.status_code, urlsplit(r.data.decode().strip()).path
+
+
+def test_archive_and_restore(fhost, app, client):
+    paths = [upload(client, data)[1] for data in FILES]
+
+    with app.app_context():
+        File = fhost.File
+        ids = [f.id for f in File.query.order_by(File.id)]
+        fhost.db.session.execute(
+            update(File).where(File.id.in_(ids[:3]))
+            .values(expiration=None, expired_at=0))
+        fhost.db.session.execute(
+            update(File).where(File.id == ids[2]).values(removed=True))
+
+        job = fhost.FetchJob("https://example.com/", False,
+                             ipaddress.ip_address("127.0.0.1"), "")
+        job.file_id = ids[1]
+        fhost.db.session.add(job)
+        fhost.db.session.add(fhost.NSFWJob(ids[0]))
+        fhost.db.session.commit()
+
+    r = app.test_cli_runner().invoke(
+        args=["db-compact", "--older-than", "0"])
+    assert "Archived 2 file(s)" in r.output, r.output
+
+    with app.app_context():
+        # Still referenced by the fetch job, and the highest ID
+        assert [f.id for f in File.query.order_by(File.id)] == \
+            [ids[1], ids[3]]
+        assert sorted(a.id for a in fhost.FileArchive.query) == \
+            [ids[0], ids[2]]
+        assert not fhost.NSFWJob.query.count()
+
+    assert client.get(paths[0]).status_code == 404
+
+    for attempt in range(2):
+        assert upload(client, FILES[0]) == (200, paths[0])
+    assert client.get(paths[0]).data == FILES[0]
+
+    with app.app_context():
+        digest = hashlib.sha256(FILES[0]).hexdigest()
+        assert [f.id for f in File.query.filter_by(sha256=digest)] == \
+            [ids[0]]
+        assert fhost.FileArchive.query.count() == 1
+
+    assert upload(client, FILES[2])[0] == 451
@@ -0,0 +1,186 @@
+"""
+    Tests for uploads by URL, against a local stand-in for the origin
+"""
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+BODY = bytes(range(256)) * 64
+
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body: bytes, **headers):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunked(self, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_GET(self):
+        Origin.requests.append((self.path, dict(self.headers)))
+        path, _, arg = self.path.lstrip("/").partition("/")
+
+        match path:
+            case "file":
+                self.send_body(BODY)
+            case "cached":
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.send_body(BODY, ETag='"v1"')
+            case "chunked":
+                self.send_chunked(BODY[i:i + 1000]
+                                  for i in range(0, len(BODY), 1000))
+            case "big":
+                self.send_body(b"x" * 100000)
+            case "big-chunked":
+                self.send_chunked(b"x" * 10000 for _ in range(100))
+            case "stall":
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(BODY)))
+                self.end_headers()
+                self.wfile.write(BODY[:100])
+                self.wfile.flush()
+                time.sleep(2)
+                self.close_connection = True
+            case "trickle":
+                self.send_chunked(
+                    (time.sleep(0.1), b"x")[1] for _ in range(30))
+            case "trickle-length":
+                self.send_response(200)
+                self.send_header("Content-Length", "30")
+                self.end_headers()
+                for _ in range(30):
+                    time.sleep(0.1)
+                    self.wfile.write(b"x")
+                    self.wfile.flush()
+            case "redirect":
+                hops = int(arg)
+                self.send_response(302)
+                self.send_header("Location", f"/redirect/{hops - 1}"
+                                 if hops > 1 else "/file")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            case _:
+                self.send_error(404)
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Clients hanging up on purpose
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = OriginServer(("127.0.0.1", 0), Origin)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def limits(app, monkeypatch):
+    monkeypatch.setitem(app.config, "MAX_CONTENT_LENGTH", 64 * 1024)
+    monkeypatch.setitem(app.config, "FHOST_FETCH_TIMEOUT", (1, 0.5))
+    monkeypatch.setitem(app.config, "FHOST_FETCH_MAX_TIME", 5)
+
+
+def fetch(client, url: str):
+    return client.post("/", data={"url": url})
+
+
+def download(client, r) -> bytes:
+    assert r.status_code == 200, r.data
+    return client.get(r.data.decode().strip()).data
+
+
+def test_fetch(client, origin, limits):
+    r = fetch(client, origin + "/file")
+    assert download(client, r) == BODY
+    assert r.headers["X-Token"]
+
+
+def test_chunked(client, origin, limits):
+    assert download(client, fetch(client, origin + "/chunked")) == BODY
+
+
+def test_redirects(client, origin, limits, app):
+    hops = app.config["FHOST_FETCH_MAX_REDIRECTS"]
+    r = fetch(client, f"{origin}/redirect/{hops}")
+    assert download(client, r) == BODY
+
+    assert fetch(client, f"{origin}/redirect/{hops + 1}").status_code == 502
+
+
+def test_oversized(client, origin, limits):
+    assert fetch(client, origin + "/big").status_code == 413
+    assert fetch(client, origin + "/big-chunked").status_code == 413
+
+
+def test_stalled(client, origin, limits):
+    assert fetch(client, origin + "/stall").status_code == 504
+
+
+def test_too_slow(client, origin, limits, monkeypatch, app):
+    monkeypatch.setitem(app.config, "FHOST_FETCH_MAX_TIME", 1)
+    for path in ("/trickle", "/trickle-length"):
+        started = time.monotonic()
+        assert fetch(client, origin + path).status_code == 504
+        assert time.monotonic() - started < 2.5
+
+
+def test_unreachable(client, limits):
+    assert fetch(client, "http://127.0.0.1:9/file").status_code == 502
+
+
+def test_origin_error(client, origin, limits):
+    r = fetch(client, origin + "/missing")
+    assert b"404" in r.data
+
+
+def test_revalidation(client, origin, limits, app, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_FETCH_CACHE_TTL", 0)
+    first = fetch(client, origin + "/cached")
+    assert download(client, first) == BODY
+
+    Origin.requests.clear()
+    second = fetch(client, origin + "/cached")
+    assert second.data == first.data
+    assert "X-Token" not in second.headers
+    assert Origin.requests[0][1]["If-None-Match"] == '"v1"'
+
+    digest = hashlib.sha256(BODY).hexdigest()
+    with app.app_context():
+        from fhost import RemoteFile
+        assert RemoteFile.get(origin + "/cached").sha256 == digest
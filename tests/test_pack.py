@@ -0,0 +1,122 @@
+"""
+    Tests for packing small files into segment files
+"""
+
+import io
+import multiprocessing
+import os
+from urllib.parse import urlsplit
+
+import pytest
+from sqlalchemy import update
+
+
+def append(args) -> list:
+    """
+    Appends blobs to a pack store like another worker would
+    """
+    root, n = args
+    from fhost import PackStore
+
+    store = PackStore(root, 4096)
+    blobs = [os.urandom(300) + b"%d-%d" % (n, i) for i in range(100)]
+    return [(store.append(data), data) for data in blobs]
+
+
+@pytest.fixture
+def packed(fhost, app, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_PACK_THRESHOLD", 2048)
+    monkeypatch.setattr(fhost.pack_store, "segment_size", 4096)
+    monkeypatch.setattr(fhost.pack_store, "_active", None)
+    return fhost.pack_store
+
+
+def upload(client, data: bytes) -> str:
+    r = client.post("/", data={"file": (io.BytesIO(data), "file.bin")})
+    assert r.status_code == 200, r.data
+    return urlsplit(r.data.decode().strip()).path
+
+
+def test_read_back(fhost, app, client, packed):
+    data = os.urandom(1000)
+    path = upload(client, data)
+
+    with app.app_context():
+        f = fhost.File.query.one()
+        assert f.pack_segment is not None
+        assert packed.read(f.pack_segment, f.pack_offset, f.size) == data
+        assert not fhost.storage_backend.exists(f.sha256)
+
+    assert client.get(path).data == data
+    r = client.get(path, headers={"Range": "bytes=10-19"})
+    assert r.status_code == 206
+    assert r.data == data[10:20]
+
+
+def test_compaction(fhost, app, client, packed):
+    # Four files fit into each segment
+    files = [os.urandom(1000) for _ in range(12)]
+    paths = [upload(client, data) for data in files]
+    assert packed.segments() == [1, 2, 3]
+
+    # Leave one file in the first segment and none in the second
+    with app.app_context():
+        fhost.db.session.execute(
+            update(fhost.File).where(fhost.File.id.in_([2, 3, 4, 5, 6, 7, 8]))
+            .values(expiration=0))
+        fhost.db.session.commit()
+
+    r = app.test_cli_runner().invoke(args=["prune"])
+    assert "Compacting pack segment 1" in r.output, r.output
+    assert packed.segments() == [1, 3, 4]
+
+    with app.app_context():
+        f = fhost.File.query.get(1)
+        assert f.pack_segment == 4
+
+    # Once nothing refers to it anymore, the old segment is deleted
+    app.test_cli_runner().invoke(args=["prune"])
+    assert packed.segments() == [3, 4]
+
+    fhost.file_cache.clear()
+    for i in 0, 8, 9, 10, 11:
+        assert client.get(paths[i]).data == files[i]
+
+
+def test_append_during_compaction(fhost, app, client, packed, monkeypatch):
+    files = [os.urandom(1000) for _ in range(8)]
+    for data in files:
+        upload(client, data)
+
+    with app.app_context():
+        fhost.db.session.execute(
+            update(fhost.File).where(fhost.File.id.in_([2, 3, 4, 6, 7, 8]))
+            .values(pack_segment=None, pack_offset=None))
+        fhost.db.session.commit()
+
+    # Other workers append while the compaction copies files
+    read = packed.read
+    ctx = multiprocessing.get_context("fork")
+    pool = ctx.Pool(4)
+
+    def read_appending(*args):
+        for blobs in pool.map(append, [(packed.root, n) for n in range(4)]):
+            appended.extend(blobs)
+        return read(*args)
+
+    appended = []
+    monkeypatch.setattr(packed, "read", read_appending)
+    with app.app_context(), pool:
+        fhost.compact_packs()
+    monkeypatch.setattr(packed, "read", read)
+
+    assert len(appended) == 400
+    for (segment, offset), data in appended:
+        assert read(segment, offset, len(data)) == data
+
+    with app.app_context():
+        # The second segment was the active one, so it was left alone
+        kept = fhost.File.query.filter(fhost.File.id.in_([1, 5]))
+        for f, data in zip(kept.order_by(fhost.File.id), [files[0], files[4]]):
+            assert f.pack_segment != 1
+            assert read(f.pack_segment, f.pack_offset, f.size) == data
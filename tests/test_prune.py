@@ -0,0 +1,140 @@
+"""
+    Tests for removing expired files
+"""
+
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import update
+
+
+@pytest.mark.parametrize("option", [["--dry-run"], ["--max-seconds", "10"]])
+def test_daemon_options(app, option):
+    r = app.test_cli_runner().invoke(args=["prune", "--daemon", *option])
+    assert r.exit_code == 2
+    assert f"{option[0]} can't be used with --daemon" in r.output
+
+
+def test_stale_spools(fhost, app, client):
+    storage = fhost.storage_layout.root
+    r = client.post("/upload", data={"size": "100", "filename": "a.txt"})
+    assert r.status_code == 201, r.data
+
+    with app.app_context():
+        active = fhost.UploadSession.query.one().getpath()
+        active.write_bytes(b"x")
+    spools = {name: storage / name for name in
+              (".ingest-crashed", ".upload-gone", ".ingest-recent")}
+    for path in spools.values():
+        path.write_bytes(b"x")
+    for path in spools[".ingest-crashed"], spools[".upload-gone"], active:
+        os.utime(path, (0, 0))
+
+    with app.app_context():
+        fhost.prune_cleanup()
+
+    assert active.exists()
+    assert spools[".ingest-recent"].exists()
+    assert not spools[".ingest-crashed"].exists()
+    assert not spools[".upload-gone"].exists()
+
+
+def expire(fhost, client, count: int, when: float = 0) -> list:
+    """
+    Uploads count files that expire at when, in milliseconds
+    """
+    for i in range(count):
+        r = client.post("/", data={"file": (io.BytesIO(b"%d" % i * 1000),
+                                            f"{i}.txt")})
+        assert r.status_code == 200, r.data
+
+    with fhost.app.app_context():
+        fhost.db.session.execute(update(fhost.File).values(expiration=when))
+        fhost.db.session.commit()
+        return [f.sha256 for f in fhost.File.query.order_by(fhost.File.id)]
+
+
+def prune(app, *args):
+    return app.test_cli_runner().invoke(args=["prune", *args])
+
+
+def pruned(fhost) -> list:
+    with fhost.app.app_context():
+        return [f.expiration is None for f in
+                fhost.File.query.order_by(fhost.File.id)]
+
+
+def test_interrupted(fhost, app, client, monkeypatch):
+    digests = expire(fhost, client, 3)
+
+    def killed():
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(fhost.db.session, "commit", killed)
+        assert prune(app).exit_code != 0
+
+    # Deleted from storage, but not marked yet
+    assert not any(map(fhost.storage_backend.exists, digests))
+    assert pruned(fhost) == [False] * 3
+
+    r = prune(app)
+    assert r.exit_code == 0, r.output
+    assert "3 file(s) were already gone" in r.output
+    assert pruned(fhost) == [True] * 3
+
+
+def test_max_seconds(fhost, app, client, monkeypatch):
+    digests = expire(fhost, client, 4)
+    remove_expired = fhost.remove_expired
+
+    def slow(*args, **kwargs):
+        remove_expired(*args, **kwargs)
+        time.sleep(0.2)
+
+    with monkeypatch.context() as m:
+        m.setattr(fhost, "remove_expired", slow)
+        r = prune(app, "--batch-size", "1", "--max-seconds", "0.3")
+    assert "run prune again to continue" in r.output
+    assert 0 < sum(pruned(fhost)) < 4
+
+    r = prune(app)
+    assert r.exit_code == 0, r.output
+    assert pruned(fhost) == [True] * 4
+    assert not any(map(fhost.storage_backend.exists, digests))
+
+
+class Stop(Exception):
+    pass
+
+
+def test_daemon_extended(fhost, app, client, monkeypatch):
+    soon = time.time() * 1000 + 500
+    extended, due = expire(fhost, client, 2, soon)
+    sleep = time.sleep
+    sleeps = 0
+
+    def fake_sleep(seconds):
+        nonlocal sleeps
+        sleeps += 1
+        if sleeps > 1:
+            raise Stop
+
+        # Extended elsewhere after the daemon loaded its heap
+        fhost.db.session.execute(
+            update(fhost.File).where(fhost.File.sha256 == extended)
+            .values(expiration=soon + 24 * 60 * 60 * 1000))
+        fhost.db.session.commit()
+        sleep(max(0, soon / 1000 - time.time()) + 0.1)
+
+    monkeypatch.setattr(fhost.time, "sleep", fake_sleep)
+    with app.app_context(), ThreadPoolExecutor(2) as pool:
+        with pytest.raises(Stop):
+            fhost.prune_daemon(pool, 100, 1, 60 * 60)
+
+    assert pruned(fhost) == [False, True]
+    assert fhost.storage_backend.exists(extended)
+    assert not fhost.storage_backend.exists(due)
@@ -0,0 +1,116 @@
+"""
+    Tests for the S3 storage backend, against moto's mock of S3
+"""
+
+import hashlib
+import io
+import os
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+BUCKET = "fhost-test"
+
+
+@pytest.fixture
+def s3(fhost, app, monkeypatch):
+    with moto.mock_aws():
+        backend = fhost.S3Storage(BUCKET, "up/", region="us-east-1",
+                                  access_key="test", secret_key="test",
+                                  part_size=5 * 1024 * 1024)
+        backend.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(fhost, "storage_backend", backend)
+        yield backend
+
+
+def ingest(fhost, data: bytes):
+    return fhost.IngestFile.from_stream(
+        io.BytesIO(data), Path(fhost.app.config["FHOST_STORAGE_PATH"]))
+
+
+def upload(client, data: bytes) -> str:
+    r = client.post("/", data={"file": (io.BytesIO(data), "file.bin")})
+    assert r.status_code == 200, r.data
+    return urlsplit(r.data.decode().strip()).path
+
+
+def test_put_open_delete(fhost, s3):
+    data = os.urandom(100000)
+    spool = ingest(fhost, data)
+    digest = spool.digest
+
+    assert not s3.exists(digest)
+    s3.put(digest, spool)
+    spool.close()
+
+    assert s3.exists(digest)
+    assert s3.stat(digest) == len(data)
+    assert list(s3.iterate()) == [digest]
+
+    with s3.open(digest) as f:
+        assert f.read() == data
+        f.seek(1000)
+        assert f.read(10) == data[1000:1010]
+        f.seek(-10, io.SEEK_END)
+        assert f.read() == data[-10:]
+
+    assert b"".join(s3.read_range(digest, 50, 150)) == data[50:150]
+
+    s3.delete(digest)
+    assert not s3.exists(digest)
+    with pytest.raises(FileNotFoundError):
+        s3.open(digest)
+
+
+def test_multipart_put(fhost, s3):
+    data = os.urandom(s3.part_size + 12345)
+    spool = ingest(fhost, data)
+    s3.put(spool.digest, spool)
+    spool.close()
+
+    with s3.open(spool.digest) as f:
+        assert f.read() == data
+
+
+def test_presigned_redirect(app, client, s3, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_S3_REDIRECT", True)
+    data = b"hello, object store\n" * 100
+    path = upload(client, data)
+
+    r = client.get(path)
+    assert r.status_code == 302
+    location = urlsplit(r.headers["Location"])
+    assert location.path.endswith("/up/" + hashlib.sha256(data).hexdigest())
+    assert "Signature" in location.query
+    assert "private" in r.headers["Cache-Control"]
+
+
+def test_proxied_ranges(app, client, s3, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_S3_REDIRECT", False)
+    data = os.urandom(300000)
+    path = upload(client, data)
+
+    r = client.get(path)
+    assert r.status_code == 200
+    assert r.data == data
+
+    r = client.get(path, headers={"Range": "bytes=1000-1999"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == f"bytes 1000-1999/{len(data)}"
+    assert r.data == data[1000:2000]
+
+    r = client.get(path, headers={"Range": "bytes=-100"})
+    assert r.status_code == 206
+    assert r.data == data[-100:]
+
+    r = client.get(path, headers={"Range": "bytes=0-9,100-109"})
+    assert r.status_code == 206
+    assert r.mimetype == "multipart/byteranges"
+    assert data[0:10] in r.data and data[100:110] in r.data
+
+    r = client.get(path, headers={"Range": f"bytes={len(data)}-"})
+    assert r.status_code == 416
@@ -0,0 +1,96 @@
+"""
+    Tests for serving files that changed after workers cached them
+"""
+
+import io
+import logging
+from urllib.parse import urlsplit
+
+import pytest
+from sqlalchemy import update
+
+
+@pytest.fixture
+def stored(fhost, app, client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_REMOVED_INDEX_INTERVAL", 0)
+
+    r = client.post("/", data={"file": (io.BytesIO(b"cached " * 100),
+                                        "file.txt")})
+    path = urlsplit(r.data.decode().strip()).path
+
+    # Now this worker has the file cached
+    assert client.get(path).status_code == 200
+
+    with app.app_context():
+        f = fhost.File.query.one()
+        yield path, f.id, f.getpath()
+
+
+def change_elsewhere(fhost, id: int, generation: str, **values):
+    """
+    Changes a file the way another process would, without this worker
+    noticing anything but the generation counter
+    """
+    fhost.db.session.execute(update(fhost.File)
+                             .where(fhost.File.id == id).values(**values))
+    fhost.Generation.bump(generation, fhost.db.session.connection())
+    fhost.db.session.commit()
+
+
+def test_banned_elsewhere(fhost, client, stored):
+    path, id, blob = stored
+    change_elsewhere(fhost, id, "removed", removed=True, expiration=None)
+    blob.unlink()
+    assert client.get(path).status_code == 451
+
+
+def test_deleted_elsewhere(fhost, client, stored):
+    path, id, blob = stored
+    change_elsewhere(fhost, id, "deleted", expiration=None)
+    blob.unlink()
+    assert client.get(path).status_code == 404
+
+
+def test_data_gone(client, stored):
+    path, id, blob = stored
+    blob.unlink()
+    assert client.get(path).status_code == 404
+
+
+def test_restored_elsewhere(fhost, app, client, monkeypatch):
+    monkeypatch.setitem(app.config, "FHOST_REMOVED_INDEX_INTERVAL", 0)
+
+    paths = []
+    for data in b"restored " * 100, b"newer " * 100:
+        r = client.post("/", data={"file": (io.BytesIO(data), "file.txt")})
+        paths.append(urlsplit(r.data.decode().strip()).path)
+
+    with app.app_context():
+        f = fhost.File.query.first()
+        f.expiration, f.expired_at = None, 0
+        id = f.id
+        fhost.db.session.commit()
+    assert "Archived 1" in app.test_cli_runner().invoke(
+        args=["db-compact", "--older-than", "0"]).output
+
+    assert client.get(paths[0]).status_code == 404
+    assert fhost.file_cache.get(id) is None
+
+    r = client.post("/", data={"file": (io.BytesIO(b"restored " * 100),
+                                        "file.txt")})
+    assert urlsplit(r.data.decode().strip()).path == paths[0]
+
+    # Another worker that still thinks the file is missing
+    fhost.file_cache.put(id, None)
+    assert client.get(paths[0]).status_code == 200
+
+
+def test_cache_stats(app, client, stored, monkeypatch, caplog):
+    path, id, blob = stored
+    monkeypatch.setitem(app.config, "FHOST_CACHE_STATS_INTERVAL", 0)
+
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        client.get(path)
+
+    assert any(r.getMessage().startswith("File cache of worker") and
+               "hit rate" in r.getMessage() for r in caplog.records)
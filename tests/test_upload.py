@@ -0,0 +1,141 @@
+"""
+    Tests for storing uploaded files
+"""
+
+import hashlib
+import io
+from urllib.parse import urlsplit
+
+import pytest
+
+DATA = b"resumable upload " * 1000
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d49484452000000010000000108060000"
+                    "001f15c4890000000d4944415478da63f8cfc0f01f0005000201"
+                    "a1e4c1b30000000049454e44ae426082")
+
+
+def start(client, size: int) -> str:
+    r = client.post("/upload", data={"size": str(size),
+                                     "filename": "file.txt"})
+    assert r.status_code == 201, r.data
+    return urlsplit(r.headers["Location"]).path
+
+
+def send(client, url: str, offset: int, data: bytes):
+    r = client.patch(url, data=data, headers={"Upload-Offset": str(offset)})
+    assert r.status_code == 204, r.data
+
+
+def finish(client, url: str) -> str:
+    r = client.post(url)
+    assert r.status_code == 200, r.data
+    return urlsplit(r.data.decode().strip()).path
+
+
+def test_resumable(client):
+    url = start(client, len(DATA))
+    send(client, url, 0, DATA[:5000])
+    send(client, url, 5000, DATA[5000:])
+    assert client.get(finish(client, url)).data == DATA
+
+
+def test_resumable_out_of_order(client):
+    url = start(client, len(DATA))
+    send(client, url, 5000, DATA[5000:])
+    send(client, url, 0, DATA[:5000])
+    assert client.get(finish(client, url)).data == DATA
+
+
+def test_resumable_overwrite(fhost, app, client):
+    url = start(client, len(DATA))
+    send(client, url, 0, DATA)
+    send(client, url, 1, b"X")
+    path = finish(client, url)
+
+    forged = DATA[:1] + b"X" + DATA[2:]
+    assert client.get(path).data == forged
+
+    with app.app_context():
+        f = fhost.File.query.one()
+        assert f.sha256 == hashlib.sha256(forged).hexdigest()
+
+
+def test_rejected_upload_stores_nothing(fhost, app, client):
+    with app.app_context():
+        fhost.db.session.add(fhost.MIMEFilter("image/png"))
+        fhost.db.session.commit()
+
+    r = client.post("/", data={"file": [
+        (io.BytesIO(b"accepted " * 100), "a.txt"),
+        (io.BytesIO(PNG), "b.txt", "text/plain")]})
+    assert r.status_code == 403
+
+    storage = fhost.storage_layout.root
+    assert not [p for p in storage.rglob("*") if p.is_file()]
+    with app.app_context():
+        assert not fhost.File.query.count()
+
+
+
+def test_failed_upload_keeps_data_put_by_others(fhost, app, client,
+                                                monkeypatch):
+    shared, doomed = b"shared " * 100, b"doomed " * 100
+    put = fhost.File._put
+
+    def failing_put(f, ingest):
+        if ingest.digest == sha(doomed):
+            raise OSError("No space left on device")
+        return put(f, ingest)
+
+    # Another worker stored the same data, but hasn't committed yet
+    with app.app_context():
+        other = fhost.IngestFile.from_stream(
+            io.BytesIO(shared), fhost.storage_layout.root)
+        assert fhost.storage_backend.put(other.digest, other)
+        assert not fhost.storage_backend.put(other.digest, other)
+        other.close()
+
+    monkeypatch.setattr(fhost.File, "_put", staticmethod(failing_put))
+    r = client.post("/", data={"file": [(io.BytesIO(shared), "a.txt"),
+                                        (io.BytesIO(doomed), "b.txt")]})
+    assert r.status_code == 500
+
+    with app.app_context():
+        assert fhost.storage_backend.exists(sha(shared))
+        assert not fhost.File.query.count()
+
+
+def test_discard_keeps_data_in_use(fhost, app, client):
+    used, unused = b"used " * 100, b"unused " * 100
+    for data in used, unused:
+        r = client.post("/", data={"file": (io.BytesIO(data), "file.txt")})
+        assert r.status_code == 200, r.data
+
+    with app.app_context():
+        fhost.File.query.filter_by(sha256=sha(unused)).delete()
+        fhost.db.session.commit()
+
+        fhost.File._discard([sha(used), sha(unused)])
+        assert fhost.storage_backend.exists(sha(used))
+        assert not fhost.storage_backend.exists(sha(unused))
+
+
+def sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_mixed_field_names_keep_order(client):
+    parts = [("file", b"first " * 100), ("file[]", b"second " * 100),
+             ("file", b"third " * 100)]
+    body = b"".join(
+        b"--sep\r\nContent-Disposition: form-data; name=\"%s\"; "
+        b"filename=\"f.txt\"\r\n\r\n%s\r\n" % (name.encode(), data)
+        for name, data in parts) + b"--sep--\r\n"
+
+    r = client.post("/", data=body,
+                    content_type="multipart/form-data; boundary=sep")
+    assert r.status_code == 200, r.data
+
+    urls = r.data.decode().split()
+    assert [client.get(urlsplit(u).path).data for u in urls] == \
+        [data for name, data in parts]